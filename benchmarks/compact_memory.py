@@ -0,0 +1,47 @@
+"""
+Memory used by forecasts as Forecast and as CompactForecast, measured with tracemalloc. Rows are built the
+way storage builds them, with a new string and Decimal object for every value.
+
+    PYTHONPATH=. python benchmarks/compact_memory.py 1000000
+"""
+import datetime
+import gc
+import sys
+import tracemalloc
+from decimal import Decimal
+
+from stockrec.compact import CompactForecast
+from stockrec.model import Forecast, Signal, Direction
+
+
+def synthetic_forecast(n):
+    return Forecast(raw=f"Analyst {n % 40} höjer Company {n % 500} till köp (behåll), riktkurs {n % 900} kronor. #{n}",
+                    extractor=''.join(['sim', 'ple']),
+                    date=datetime.date(2015, 1, 1) + datetime.timedelta(n % 3000),
+                    analyst=f"Analyst {n % 40}",
+                    change_direction=Direction.RAISE,
+                    company=f"Company {n % 500}",
+                    signal=Signal.BUY,
+                    prev_signal=Signal.HOLD,
+                    forecast_price=Decimal(f"{n % 900}.{n % 100:02d}00"),
+                    prev_forecast_price=Decimal(f"{n % 800}.5000") if n % 3 else None,
+                    currency=''.join(['SE', 'K']))
+
+
+def measure(count, build):
+    gc.collect()
+    tracemalloc.start()
+    rows = [build(synthetic_forecast(n)) for n in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rows
+    return size
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    plain = measure(count, lambda f: f)
+    compact = measure(count, CompactForecast)
+    print(f"Forecast:        {plain / count:6.0f} bytes/row, {plain / 2 ** 20:7.1f} MiB for {count} rows")
+    print(f"CompactForecast: {compact / count:6.0f} bytes/row, {compact / 2 ** 20:7.1f} MiB for {count} rows")
+    print(f"Saved {100 * (1 - compact / plain):.0f}%")
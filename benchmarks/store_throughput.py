@@ -0,0 +1,50 @@
+"""
+Bulk load throughput of a storage backend. Stores synthetic forecasts in batches and reports forecasts per
+second, for new forecasts and for storing the same forecasts again.
+
+    python benchmarks/store_throughput.py sqlite:/tmp/bench.db 100000
+    STOCKREC_STORAGE=postgres python benchmarks/store_throughput.py postgres 100000
+"""
+import datetime
+import sys
+import time
+from decimal import Decimal
+
+from stockrec.model import Forecast, Signal, Direction
+from stockrec.parallel import chunked
+from stockrec.storage import open_storage
+
+
+def synthetic_forecasts(count):
+    start = datetime.date(2015, 1, 1)
+    for n in range(count):
+        yield Forecast(raw=f"Analyst {n % 40} höjer Company {n % 500} till köp (behåll), riktkurs {n % 900} kronor. #{n}",
+                       extractor='simple',
+                       date=start + datetime.timedelta(n % 3000),
+                       analyst=f"Analyst {n % 40}",
+                       change_direction=Direction.RAISE,
+                       company=f"Company {n % 500}",
+                       signal=Signal.BUY,
+                       prev_signal=Signal.HOLD,
+                       forecast_price=Decimal(n % 900),
+                       currency='SEK')
+
+
+def run(storage, count, batch_size):
+    start = time.monotonic()
+    total = None
+    for batch in chunked(synthetic_forecasts(count), batch_size):
+        result = storage.store_many(batch, batch_size)
+        total = result if total is None else total + result
+    elapsed = time.monotonic() - start
+    return total, count / elapsed
+
+
+if __name__ == '__main__':
+    url = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    storage = open_storage(url)
+    for label in ['new', 'unchanged']:
+        result, rate = run(storage, count, batch_size)
+        print(f"{url} {label}: {result}, {rate:.0f} forecasts/s")
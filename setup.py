@@ -48,6 +48,8 @@ setup(
                       'beautifulsoup4',
                       'pg8000',
                       'fire'],
+    extras_require={'analytics': ['numpy'],
+                    'export': ['pyarrow']},
     tests_require=['pytest',
                    'nose'],
     test_suite='tests',
@@ -1,55 +1,209 @@
+import atexit
 import datetime
+import functools
 import logging
+import os
+import time
 
 import fire
 
-from stockrec.extract import extract_forecast
-from stockrec.fetch import get_forecasts
+from stockrec import metrics
+from stockrec.archive import read_pages
+from stockrec.export import export_forecasts
+from stockrec.extract import refresh_forecasts
+from stockrec.fetch import Fetcher, HtmlCache, TemplateIndex, url_templates
+from stockrec.parallel import chunked, process_map
 from stockrec.pgstore import ForecastStorage
+from stockrec.pipeline import run_pipeline, fetch_page
+from stockrec.storage import StoreResult, open_storage
+
+
+def _parse_date(value):
+    return datetime.date.fromisoformat(str(value)[:10]) if value else None
+
+
+def _print_forecasts(forecasts):
+    for f in forecasts:
+        print('\t'.join(str(v) if v is not None else '' for v in [f.date,
+                                                                   f.analyst,
+                                                                   f.company,
+                                                                   f.change_direction.name,
+                                                                   f.signal.name,
+                                                                   f.prev_signal.name,
+                                                                   f.forecast_price,
+                                                                   f.prev_forecast_price,
+                                                                   f.currency]))
+
+
+def _log_store_result(result):
+    logging.info(f"Stored {result.inserted} new and {result.updated} updated forecasts, "
+                 f"{result.unchanged} were unchanged.")
+
+
+def _log_pipeline_result(result, elapsed):
+    elapsed = max(elapsed, 1e-9)
+    logging.info(f"Processed {result.pages} pages and {result.statements} statements in {elapsed:.1f}s, "
+                 f"{result.pages / elapsed:.1f} pages/s and {result.statements / elapsed:.1f} statements/s.")
+    _log_store_result(result.stored)
 
 
 class Stockrec(object):
     """Scrape new stock forecasts."""
 
-    def __init__(self, log_level='INFO'):
+    def __init__(self, log_level='INFO', cache_dir=None, cache_size_mb=512, storage=None, metrics_file=None,
+                 metrics_json=None):
+        """
+        Storage is 'postgres' or 'sqlite:<path>', defaults to STOCKREC_STORAGE or postgres. With metrics_file or
+        metrics_json, or STOCKREC_METRICS_FILE or STOCKREC_METRICS_JSON, latencies and counts of fetching,
+        parsing, extraction and storage are written as Prometheus text or a JSON summary when the command ends.
+        Extraction in worker processes is not included.
+        """
         logging.basicConfig(level=log_level)
+        self._storage = storage
+        metrics_file = metrics_file or os.getenv("STOCKREC_METRICS_FILE")
+        metrics_json = metrics_json or os.getenv("STOCKREC_METRICS_JSON")
+        if metrics_file or metrics_json:
+            metrics.enable()
+            atexit.register(metrics.write, metrics_file, metrics_json)
+        cache_dir = cache_dir or os.getenv("STOCKREC_CACHE_DIR")
+        self._cache = HtmlCache(cache_dir, int(cache_size_mb) * 1024 * 1024) if cache_dir else None
+        self._index = TemplateIndex(os.path.join(cache_dir, 'templates.json')) if cache_dir else None
 
     def today(self, url=None):
-        """Scrape forecasts from today."""
-        storage_con = ForecastStorage()
-        for f in get_forecasts(datetime.date.today(), url):
-            storage_con.store(f)
+        """Scrape forecasts from today, from url if given. The usual urls are tried if url has no page."""
+        storage_con = open_storage(self._storage)
+        with Fetcher(cache=self._cache, index=self._index) as fetcher:
+            result = run_pipeline([datetime.date.today()], storage_con, functools.partial(fetch_page, fetcher, url=url))
+        _log_store_result(result.stored)
 
-    def range(self, start, stop=datetime.date.today().isoformat()):
-        """Scrape forecasts from start date to stop date."""
+    def range(self, start, stop=datetime.date.today().isoformat(), workers=1, timeout=10.0, parse_workers=1,
+              batch_size=500):
+        """
+        Scrape forecasts from start date to stop date. Fetches up to workers days concurrently while earlier
+        days are extracted in parse_workers processes and stored in batches of batch_size.
+        """
         start_date = datetime.date.fromisoformat(start[:10])
         stop_date = datetime.date.fromisoformat(stop[:10])
-        storage_con = ForecastStorage()
+        storage_con = open_storage(self._storage)
         day_count = (stop_date - start_date).days + 1
-        for date in [start_date + datetime.timedelta(n) for n in range(day_count)]:
-            logging.debug(f"Processing {date}.")
-            for f in get_forecasts(date):
-                storage_con.store(f)
-
-    def refresh(self):
-        """Refresh values in database based on earlier refreshed strings. Useful after a recent update of stockrec."""
-        storage_con = ForecastStorage()
+        dates = [start_date + datetime.timedelta(n) for n in range(day_count)]
+        start_time = time.monotonic()
+        with Fetcher(pool_size=len(url_templates) * int(workers),
+                     timeout=float(timeout),
+                     cache=self._cache,
+                     index=self._index) as fetcher:
+            result = run_pipeline(dates,
+                                  storage_con,
+                                  functools.partial(fetch_page, fetcher),
+                                  fetch_workers=int(workers),
+                                  parse_workers=int(parse_workers),
+                                  batch_size=int(batch_size))
+        logging.info(f"Of total {day_count} days, {result.failed} could not be processed.")
+        _log_pipeline_result(result, time.monotonic() - start_time)
+
+    def ingest(self, path, workers=None, batch_size=500):
+        """Store forecasts from saved pages in a directory or tarball. File names must contain the date of the page."""
+        storage_con = open_storage(self._storage)
+        start_time = time.monotonic()
+        result = run_pipeline(read_pages(path),
+                              storage_con,
+                              parse_workers=int(workers or os.cpu_count()),
+                              batch_size=int(batch_size))
+        logging.info(f"Of total {result.pages} pages, {result.failed} could not be processed.")
+        _log_pipeline_result(result, time.monotonic() - start_time)
+
+    def refresh(self, full=False, workers=1, chunk_size=1000, start=None, stop=None):
+        """
+        Refresh values in database based on earlier refreshed strings. Useful after a recent update of stockrec.
+        Only forecasts extracted by an older version of an extractor, or failed by older extractors, are refreshed
+        unless full is set. With several workers, chunks of forecasts are extracted in parallel processes.
+        Optionally limited to forecasts from start date to stop date.
+        """
+        storage_con = open_storage(self._storage)
         no_processed = 0
         no_failed = 0
         no_refreshed = 0
-        for f in storage_con.fetch_stored_raw():
-            no_processed += 1
-            new_f = extract_forecast(f.raw, f.date)
-            if new_f.extractor is None:
-                no_failed += 1
-                logging.warning(f"Could not extract: {f.raw}")
-            elif new_f != f:
-                no_refreshed += 1
-                storage_con.store(new_f)
+        total = StoreResult()
+        forecasts = storage_con.fetch_stored_raw(stale_only=not full, start=_parse_date(start), stop=_parse_date(stop))
+        chunks = chunked(forecasts, int(chunk_size))
+        # Unchanged forecasts fetched as stale are stored again to record the current extractor version.
+        refresh_chunk = functools.partial(refresh_forecasts, keep_unchanged=not full)
+        for processed, changed, unchanged, failed in process_map(refresh_chunk, chunks, int(workers)):
+            no_processed += processed
+            no_failed += len(failed)
+            no_refreshed += len(changed)
+            for raw in failed:
+                logging.warning(f"Could not extract: {raw}")
+            total += storage_con.store_many(changed + unchanged)
+        if no_processed == 0:
+            logging.info("No forecasts to refresh.")
+            return
         percent_failed = int(100*float(no_failed)/float(no_processed))
         percent_refreshed = int(100*float(no_refreshed)/float(no_processed))
         logging.info(f"Of total {no_processed} forecasts, {no_failed}({percent_failed}%) could not be parsed.")
         logging.info(f"Of total {no_processed} forecasts, {no_refreshed}({percent_refreshed}%) was updated.")
+        _log_store_result(total)
+
+    def export(self, path, format=None, start=None, stop=None, company=None, chunk_size=10000):
+        """
+        Export forecasts ordered by date to a csv, Parquet or Arrow IPC file, given by format or the suffix of
+        path. Optionally limited to a date range and a company.
+        """
+        start_time = time.monotonic()
+        rows = export_forecasts(open_storage(self._storage),
+                                path,
+                                format,
+                                _parse_date(start),
+                                _parse_date(stop),
+                                company,
+                                int(chunk_size))
+        logging.info(f"Exported {rows} forecasts to {path} in {time.monotonic() - start_time:.1f}s.")
+
+    def backfill(self):
+        """
+        Set the analyst and company ids of forecasts in Postgres stored before they were kept. Afterwards forecasts
+        are read by id and the indexes on analyst and company names are dropped.
+        """
+        ForecastStorage().backfill_ids()
+
+    def partition(self):
+        """Migrate the forecasts table in Postgres to a table partitioned by year on date."""
+        ForecastStorage().migrate_to_partitioned()
+
+    def consensus(self, company=None, rebuild=False, days=None):
+        """
+        Print the consensus of each company, kept in Postgres: the number of analysts, their buy, hold and sell
+        signals, mean and median forecast price in the most used currency, and raises and lowers in the window.
+        With rebuild, compute it for all companies, for instance after refresh, counting raises and lowers over the
+        last days days. The window is kept for later updates, it defaults to the window of the last rebuild or
+        90 days.
+        """
+        storage_con = ForecastStorage(consensus_days=int(days) if days else None)
+        if rebuild:
+            storage_con.rebuild_consensus()
+        for c in storage_con.consensus(company):
+            print('\t'.join(str(v) if v is not None else '' for v in c))
+
+    def company(self, name, start=None, stop=None):
+        """Print forecasts for a company, optionally from start date to stop date."""
+        storage_con = open_storage(self._storage)
+        _print_forecasts(storage_con.forecasts_for_company(name, _parse_date(start), _parse_date(stop)))
+
+    def latest(self, company=None):
+        """Print the latest forecast of each analyst, for all companies or a single company."""
+        _print_forecasts(open_storage(self._storage).latest_per_analyst(company))
+
+    def list(self, after=None, limit=100, start=None, stop=None, company=None):
+        """Print a page of forecasts ordered by date. Continue with the after value logged at the end."""
+        storage_con = open_storage(self._storage)
+        if after is not None:
+            after_date, after_md5 = str(after).split(':')
+            after = (_parse_date(after_date), after_md5)
+        forecasts = storage_con.list_forecasts(after, int(limit), _parse_date(start), _parse_date(stop), company)
+        _print_forecasts(forecasts)
+        if len(forecasts) == int(limit):
+            next_date, next_md5 = storage_con.page_key(forecasts[-1])
+            logging.info(f"More forecasts with --after {next_date}:{next_md5}")
 
 
 if __name__ == '__main__':
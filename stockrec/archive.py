@@ -0,0 +1,64 @@
+import datetime
+import gzip
+import logging
+import os
+import re
+import tarfile
+from typing import Iterator, Optional, Tuple
+
+from stockrec.extract import extract_forecasts
+from stockrec.fetch import get_statements
+
+_page_suffixes = ('.html', '.htm', '.html.gz', '.htm.gz')
+_date_pattern = re.compile(r'(\d{4})[/_-]?(\d{2})[/_-]?(\d{2})')
+
+
+def date_from_name(name: str) -> Optional[datetime.date]:
+    """Find the date of a saved page from its path, for instance '2020/05/14/...' or 'page-2020-05-14.html'."""
+    for m in _date_pattern.finditer(name):
+        try:
+            return datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        except ValueError:
+            continue
+    return None
+
+
+def _decode(name: str, data: bytes) -> str:
+    if name.endswith('.gz'):
+        data = gzip.decompress(data)
+    return data.decode('utf-8', errors='replace')
+
+
+def _named_files(path: str) -> Iterator[Tuple[str, bytes]]:
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                if file.endswith(_page_suffixes):
+                    full_path = os.path.join(root, file)
+                    with open(full_path, 'rb') as f:
+                        yield os.path.relpath(full_path, path), f.read()
+    else:
+        with tarfile.open(path, 'r:*') as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith(_page_suffixes):
+                    yield member.name, tar.extractfile(member).read()
+
+
+def read_pages(path: str) -> Iterator[Tuple[str, datetime.date, str]]:
+    """Yield (name, date, html) for every saved page in a directory or a tarball."""
+    for name, data in _named_files(path):
+        date = date_from_name(name)
+        if date is None:
+            logging.warning(f"Skipping {name}, no date found in its name.")
+            continue
+        yield name, date, _decode(name, data)
+
+
+def extract_page(page: Tuple[str, datetime.date, str]):
+    """Extract all forecasts of a saved page. Returns (name, date, forecasts, error)."""
+    name, date, html = page
+    try:
+        return name, date, list(extract_forecasts(get_statements(html), date)), None
+    except Exception as e:
+        return name, date, [], e
@@ -0,0 +1,112 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from stockrec.compact import CompactForecast, price_scale
+from stockrec.model import Forecast, Signal, Direction
+from stockrec.storage import Storage
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("ForecastBatch needs numpy, install it with pip install stockrec[analytics].")
+
+
+def _encode(values: List[Optional[str]]) -> Tuple['np.ndarray', List[str]]:
+    """Dictionary encode values as codes into a list of distinct values, None is coded as -1."""
+    codes = {}
+    encoded = np.fromiter((-1 if v is None else codes.setdefault(v, len(codes)) for v in values),
+                          dtype=np.int32, count=len(values))
+    return encoded, list(codes)
+
+
+def _price(forecast, units: str, name: str) -> float:
+    if isinstance(forecast, CompactForecast):
+        value = getattr(forecast, units)
+        if isinstance(value, int):
+            return value / 10 ** price_scale
+    value = getattr(forecast, name)
+    return float(value) if value is not None else np.nan
+
+
+class ForecastBatch:
+    """
+    Forecasts as columns, for vectorized analytics with numpy. Dates are datetime64[D], signals and directions
+    their Enum values, prices floats with NaN when missing. Analysts, companies and currencies are dictionary
+    encoded as codes into a list of names, with -1 when missing.
+    """
+
+    def __init__(self, forecasts: List):
+        _require_numpy()
+        count = len(forecasts)
+        self.dates = np.array([f.date for f in forecasts], dtype='datetime64[D]')
+        self.signals = np.fromiter((f.signal.value for f in forecasts), dtype=np.int8, count=count)
+        self.prev_signals = np.fromiter((f.prev_signal.value for f in forecasts), dtype=np.int8, count=count)
+        self.directions = np.fromiter((f.change_direction.value for f in forecasts), dtype=np.int8, count=count)
+        self.prices = np.fromiter((_price(f, 'price_units', 'forecast_price') for f in forecasts),
+                                  dtype=np.float64, count=count)
+        self.prev_prices = np.fromiter((_price(f, 'prev_price_units', 'prev_forecast_price')
+                                        for f in forecasts),
+                                       dtype=np.float64, count=count)
+        self.analyst_codes, self.analysts = _encode([f.analyst for f in forecasts])
+        self.company_codes, self.companies = _encode([f.company for f in forecasts])
+        self.currency_codes, self.currencies = _encode([f.currency for f in forecasts])
+
+    @classmethod
+    def from_forecasts(cls, forecasts: Iterable[Forecast]) -> 'ForecastBatch':
+        """Batch of forecasts, for instance from extract_forecasts."""
+        return cls(list(forecasts))
+
+    @classmethod
+    def from_storage(cls, storage: Storage, **filters) -> 'ForecastBatch':
+        """Batch of stored forecasts, filtered like fetch_stored_raw. Rows are read as compact forecasts."""
+        return cls(list(storage.fetch_stored_raw(compact=True, **filters)))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def price_change(self) -> 'np.ndarray':
+        """Relative change of the target price from the previous one, NaN when either is missing or zero."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = self.prices / self.prev_prices - 1.0
+        change[~np.isfinite(change)] = np.nan
+        return change
+
+    def _per_company(self, mask: 'np.ndarray') -> Dict[str, int]:
+        mask = mask & (self.company_codes >= 0)
+        counts = np.bincount(self.company_codes[mask], minlength=len(self.companies))
+        return {company: int(n) for company, n in zip(self.companies, counts) if n > 0}
+
+    def _known_signals(self) -> 'np.ndarray':
+        return (self.signals != Signal.UNKNOWN.value) & (self.prev_signals != Signal.UNKNOWN.value)
+
+    def upgrades_per_company(self) -> Dict[str, int]:
+        """Number of forecasts with a stronger signal than the previous one, per company."""
+        return self._per_company(self._known_signals() & (self.signals > self.prev_signals))
+
+    def downgrades_per_company(self) -> Dict[str, int]:
+        """Number of forecasts with a weaker signal than the previous one, per company."""
+        return self._per_company(self._known_signals() & (self.signals < self.prev_signals))
+
+    def revision_rates(self, window_days: int = 90) -> 'np.ndarray':
+        """
+        For each forecast, the share of forecasts by the same analyst in the window_days days up to and
+        including its date that raised or lowered the target price. NaN for forecasts without analyst.
+        """
+        revised = (self.directions == Direction.RAISE.value) | (self.directions == Direction.LOWER.value)
+        days = self.dates.astype(np.int64)
+        # One sorted key per forecast, analyst first, so the window of a forecast is a contiguous range.
+        span = int(days.max() - days.min()) + window_days + 1 if len(self) > 0 else 1
+        keys = self.analyst_codes.astype(np.int64) * span + (days - (days.min() if len(self) > 0 else 0))
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        ends = np.searchsorted(sorted_keys, sorted_keys, side='right')
+        starts = np.searchsorted(sorted_keys, sorted_keys - (window_days - 1), side='left')
+        revisions = np.concatenate(([0], np.cumsum(revised[order])))
+        rates = np.empty(len(self), dtype=np.float64)
+        rates[order] = (revisions[ends] - revisions[starts]) / (ends - starts)
+        rates[self.analyst_codes < 0] = np.nan
+        return rates
@@ -0,0 +1,138 @@
+import datetime
+import sys
+from decimal import Decimal
+from typing import Iterable, Iterator, Optional, Tuple, Union
+
+from stockrec.model import Forecast, Signal, Direction
+
+# Prices are kept as integers in units of 10^-price_scale, the precision of prices in the database. The
+# exponent of the Decimal is kept too, so 220 and 220.0000 come back as they were.
+price_scale = 4
+_min_exponent = -price_scale
+_max_exponent = 3
+_max_units = 10 ** 18
+
+_signals = {s.value: s for s in Signal}
+_directions = {d.value: d for d in Direction}
+_dates = {}
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value is not None else None
+
+
+def _shared_date(date: datetime.date) -> datetime.date:
+    return _dates.setdefault(date, date)
+
+
+def _pack_price(price: Optional[Decimal]) -> Tuple[Union[int, Decimal, None], int]:
+    """A price as (fixed point integer, exponent), or the Decimal itself if it does not fit."""
+    if price is None or not price.is_finite():
+        return price, 0
+    exponent = price.as_tuple().exponent
+    units = int(price.scaleb(price_scale)) if _min_exponent <= exponent <= _max_exponent else None
+    if units is None or abs(units) >= _max_units:
+        return price, 0
+    return units, exponent
+
+
+def _unpack_price(value: Union[int, Decimal, None], exponent: int) -> Optional[Decimal]:
+    if not isinstance(value, int):
+        return value
+    return Decimal(value).scaleb(-price_scale).quantize(Decimal(1).scaleb(exponent))
+
+
+class CompactForecast:
+    """
+    Memory efficient forecast for large sets of forecasts. Strings are interned and dates shared, signals and
+    directions kept as small integer codes and prices as fixed point integers. Has the same attributes as
+    Forecast and converts to and from it without loss.
+    """
+
+    __slots__ = ('raw',
+                 'extractor',
+                 'date',
+                 'analyst',
+                 'company',
+                 'currency',
+                 'direction_code',
+                 'signal_code',
+                 'prev_signal_code',
+                 'price_units',
+                 'price_exponent',
+                 'prev_price_units',
+                 'prev_price_exponent')
+
+    def __init__(self, forecast: Forecast):
+        self.raw = forecast.raw
+        self.extractor = _intern(forecast.extractor)
+        self.date = _shared_date(forecast.date)
+        self.analyst = _intern(forecast.analyst)
+        self.company = _intern(forecast.company)
+        self.currency = _intern(forecast.currency)
+        self.direction_code = forecast.change_direction.value
+        self.signal_code = forecast.signal.value
+        self.prev_signal_code = forecast.prev_signal.value
+        self.price_units, self.price_exponent = _pack_price(forecast.forecast_price)
+        self.prev_price_units, self.prev_price_exponent = _pack_price(forecast.prev_forecast_price)
+
+    @property
+    def change_direction(self) -> Direction:
+        return _directions[self.direction_code]
+
+    @property
+    def signal(self) -> Signal:
+        return _signals[self.signal_code]
+
+    @property
+    def prev_signal(self) -> Signal:
+        return _signals[self.prev_signal_code]
+
+    @property
+    def forecast_price(self) -> Optional[Decimal]:
+        return _unpack_price(self.price_units, self.price_exponent)
+
+    @property
+    def prev_forecast_price(self) -> Optional[Decimal]:
+        return _unpack_price(self.prev_price_units, self.prev_price_exponent)
+
+    def to_forecast(self) -> Forecast:
+        return Forecast(raw=self.raw,
+                        extractor=self.extractor,
+                        date=self.date,
+                        analyst=self.analyst,
+                        change_direction=self.change_direction,
+                        company=self.company,
+                        signal=self.signal,
+                        prev_signal=self.prev_signal,
+                        forecast_price=self.forecast_price,
+                        prev_forecast_price=self.prev_forecast_price,
+                        currency=self.currency)
+
+    def _replace(self, **changes) -> 'CompactForecast':
+        return CompactForecast(self.to_forecast()._replace(**changes))
+
+    def __eq__(self, other):
+        if isinstance(other, CompactForecast):
+            other = other.to_forecast()
+        if isinstance(other, Forecast):
+            return self.to_forecast() == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.to_forecast())
+
+    def __repr__(self):
+        return 'Compact' + repr(self.to_forecast())
+
+    def __getstate__(self):
+        return self.to_forecast()
+
+    def __setstate__(self, forecast: Forecast):
+        self.__init__(forecast)
+
+
+def compact(forecasts: Iterable[Forecast]) -> Iterator[CompactForecast]:
+    """Compact forecasts, forecasts that already are compact are kept as they are."""
+    for f in forecasts:
+        yield f if isinstance(f, CompactForecast) else CompactForecast(f)
@@ -0,0 +1,137 @@
+import csv
+import datetime
+import os
+from typing import Iterable, Iterator, List
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from stockrec.model import Forecast
+from stockrec.storage import Storage, raw_md5
+
+export_formats = ['csv', 'parquet', 'arrow']
+_suffixes = {'.csv': 'csv', '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow'}
+
+_columns = ['date',
+            'analyst',
+            'company',
+            'direction',
+            'signal',
+            'prev_signal',
+            'forecast_price',
+            'prev_forecast_price',
+            'currency',
+            'extractor',
+            'raw',
+            'md5']
+
+
+def _values(f: Forecast) -> list:
+    return [f.date,
+            f.analyst,
+            f.company,
+            f.change_direction.name,
+            f.signal.name,
+            f.prev_signal.name,
+            f.forecast_price,
+            f.prev_forecast_price,
+            f.currency,
+            f.extractor,
+            f.raw,
+            raw_md5(f.raw)]
+
+
+def _schema():
+    # Plain strings instead of dictionary types, so the Arrow file can be read zero-copy from a memory map.
+    # Parquet dictionary encodes the repeated strings on its own.
+    price = pa.decimal128(12, 4)
+    return pa.schema([('date', pa.date32()),
+                      ('analyst', pa.string()),
+                      ('company', pa.string()),
+                      ('direction', pa.string()),
+                      ('signal', pa.string()),
+                      ('prev_signal', pa.string()),
+                      ('forecast_price', price),
+                      ('prev_forecast_price', price),
+                      ('currency', pa.string()),
+                      ('extractor', pa.string()),
+                      ('raw', pa.string()),
+                      ('md5', pa.string())])
+
+
+def month_groups(forecasts: Iterable[Forecast], max_rows: int) -> Iterator[List[Forecast]]:
+    """Split forecasts ordered by date into lists of the same month, of at most max_rows forecasts."""
+    group = []
+    month = None
+    for f in forecasts:
+        if len(group) > 0 and ((f.date.year, f.date.month) != month or len(group) >= max_rows):
+            yield group
+            group = []
+        month = (f.date.year, f.date.month)
+        group.append(f)
+    if len(group) > 0:
+        yield group
+
+
+def _write_csv(path: str, forecasts: Iterable[Forecast]) -> int:
+    rows = 0
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(_columns)
+        for f in forecasts:
+            writer.writerow(['' if v is None else v for v in _values(f)])
+            rows += 1
+    return rows
+
+
+def _write_arrow(path: str, fmt: str, groups: Iterable[List[Forecast]]) -> int:
+    schema = _schema()
+    rows = 0
+    writer = pq.ParquetWriter(path, schema) if fmt == 'parquet' else pa.ipc.new_file(path, schema)
+    try:
+        for group in groups:
+            columns = list(zip(*(_values(f) for f in group)))
+            batch = pa.RecordBatch.from_arrays([pa.array(c, type=t) for c, t in zip(columns, schema.types)],
+                                               schema=schema)
+            if fmt == 'parquet':
+                writer.write_table(pa.Table.from_batches([batch]), row_group_size=len(group))
+            else:
+                writer.write_batch(batch)
+            rows += len(group)
+    finally:
+        writer.close()
+    return rows
+
+
+def export_format(path: str, fmt: str = None) -> str:
+    """The format to export to, given or from the suffix of path, csv if unknown."""
+    fmt = fmt or _suffixes.get(os.path.splitext(path)[1].lower(), 'csv')
+    if fmt not in export_formats:
+        raise ValueError(f"Unknown export format {fmt}, expected one of {', '.join(export_formats)}.")
+    if fmt != 'csv' and pa is None:
+        raise ImportError(f"Export to {fmt} needs pyarrow, install it with pip install stockrec[export] or use csv.")
+    return fmt
+
+
+def export_forecasts(storage: Storage,
+                     path: str,
+                     fmt: str = None,
+                     start: datetime.date = None,
+                     stop: datetime.date = None,
+                     company: str = None,
+                     chunk_size: int = 10000,
+                     max_rows_per_group: int = 100000) -> int:
+    """
+    Export forecasts ordered by date to path as csv, Parquet or an Arrow IPC file, optionally filtered on a date
+    range and company. Forecasts are read chunk_size at a time and written in row groups, or record batches, of a
+    single month with at most max_rows_per_group rows, so memory use does not grow with the table. Returns the
+    number of exported forecasts.
+    """
+    fmt = export_format(path, fmt)
+    forecasts = storage.iter_forecasts(start, stop, company, chunk_size)
+    if fmt == 'csv':
+        return _write_csv(path, forecasts)
+    return _write_arrow(path, fmt, month_groups(forecasts, max_rows_per_group))
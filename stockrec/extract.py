@@ -1,10 +1,15 @@
 import datetime
 import decimal
+import hashlib
+import inspect
 import logging
 import re
+import time
 
-from stockrec import model
-from typing import List
+from stockrec import metrics, model
+from stockrec.compact import CompactForecast
+from stockrec.names import _canonical, analyst_aliases, company_aliases, canonical_analyst, canonical_company
+from typing import List, Optional, Callable, NamedTuple, Collection, Dict, Iterable, Tuple, FrozenSet
 
 from stockrec.model import Direction, Signal, text_to_signal, text_to_direction
 
@@ -66,30 +71,54 @@ def merge_parenthesis_tokens(tokens: List) -> List:
     return result
 
 
-_terms = ['market perform', 'sector perform', 'norska kronor', 'danska kronor', 'brittiska pund', 'kanadensiska dollar']
-_terms_start = [term.split( )[0] for term in _terms]
+class TermMatcher:
+    """
+    Trie over the words of known terms. Finds terms of any number of words in a list of tokens in a single
+    pass, preferring the longest term, and tags each match with the kinds of vocabulary it belongs to.
+    """
+
+    _no_kinds = frozenset()
+
+    def __init__(self, vocabularies: Dict[str, Iterable[str]]):
+        self._root = {}
+        for kind, terms in vocabularies.items():
+            for term in terms:
+                node = self._root
+                for word in term.split():
+                    node = node.setdefault(word, {})
+                node[None] = node.get(None, self._no_kinds) | {kind}
+
+    def match(self, tokens: List[str]) -> Tuple[List[str], List[FrozenSet[str]]]:
+        result = []
+        kinds = []
+        start = 0
+        while start < len(tokens):
+            node = self._root
+            end = start + 1
+            term_kinds = self._no_kinds
+            pos = start
+            while pos < len(tokens) and tokens[pos] in node:
+                node = node[tokens[pos]]
+                pos += 1
+                if None in node:
+                    end = pos
+                    term_kinds = node[None]
+            result.append(' '.join(tokens[start:end]))
+            kinds.append(term_kinds)
+            start = end
+        return result, kinds
+
+
+vocabulary = TermMatcher({'signal': text_to_signal.keys(),
+                          'direction': text_to_direction.keys(),
+                          'currency': currencies.keys()})
 
 
 def merge_terms_in_tokens(tokens: List) -> List:
     """
     Merge terms that consists of multiple words into one term. For instance 'market perform'.
     """
-    result=[]
-    holder=None
-    for t in tokens:
-        if holder is None:
-            if t in _terms_start:
-                holder = t
-            else:
-                result.append(t)
-        else:
-            if holder + ' ' + t in _terms:
-                result.append(holder + ' ' + t)
-            else:
-                result.append(holder)
-                result.append(t)
-            holder = None
-    return result
+    return vocabulary.match(tokens)[0]
 
 
 def is_numeric(str: str) -> bool:
@@ -127,26 +156,73 @@ def merge_number_tokens(tokens: List) -> List:
     return result
 
 
-def tokenize(text: str) -> List:
+def tokenize_tagged(text: str) -> Tuple[List[str], List[FrozenSet[str]]]:
+    """
+    Tokenize text and tag each token with the kinds of vocabulary it belongs to, 'signal', 'direction'
+    and/or 'currency'.
+    """
     cleaned_text = re.sub("\\.([A-Z])", " \\1", text)
     tokens = [s.strip(u',.\xa0') for s in cleaned_text.split(' ') if s != '']
     tokens = [t for t in tokens if t not in ['*']]
     tokens = merge_number_tokens(tokens)
     tokens = merge_parenthesis_tokens(tokens)
-    tokens = merge_terms_in_tokens(tokens)
-    return tokens
+    return vocabulary.match(tokens)
+
+
+def tokenize(text: str) -> List:
+    return tokenize_tagged(text)[0]
 
 
-def extract_simple(text: str, date: datetime.date):
+class Statement:
+    """
+    A statement tokenized once, together with the positions of its tokens. Shared by all extractors so
+    lookups of keywords do not need to scan the token list.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens, kinds = tokenize_tagged(text)
+        self._positions = {}
+        for idx, t in enumerate(self.tokens):
+            self._positions.setdefault(t, []).append(idx)
+        self.direction_idx = [idx for idx, k in enumerate(kinds) if 'direction' in k]
+        self.signal_idx = [idx for idx, k in enumerate(kinds) if 'signal' in k]
+        self.currency_idx = [idx for idx, k in enumerate(kinds) if 'currency' in k]
+
+    def __contains__(self, token: str) -> bool:
+        return token in self._positions
+
+    def has_any(self, values) -> bool:
+        return not self._positions.keys().isdisjoint(values)
+
+    def idx(self, values) -> List[int]:
+        """Positions of tokens in values, same as idx_in_list(tokens, values)."""
+        found = [self._positions[v] for v in values if v in self._positions]
+        if len(found) == 1:
+            return found[0]
+        return sorted(idx for positions in found for idx in positions)
+
+    def single_idx(self, values) -> int:
+        """Position of the only token in values, same as single_idx_in_list(tokens, values)."""
+        idx = self.idx(values)
+        if len(idx) == 0:
+            return -1
+        elif len(idx) > 1:
+            return -2
+        return idx[0]
+
+
+def extract_simple(text: str, date: datetime.date, statement: Statement = None):
     # Kepler Cheuvreux sänker LVMH till behåll (köp), riktkurs 400 euro.
     # Bank of America Merrill Lynch sänker EQT till underperform (neutral)
     if 'riktkursen för' in text:
         return None
-    tokens = tokenize(text)
-    direction_idx = idx_in_list(tokens, text_to_direction.keys())
-    till_idx = idx_in_list(tokens, ['till'])
-    signal_idx = idx_in_list(tokens, text_to_signal.keys())
-    forecast_idx = idx_in_list(tokens, ['riktkurs'])
+    statement = statement or Statement(text)
+    tokens = statement.tokens
+    direction_idx = statement.direction_idx
+    till_idx = statement.idx(['till'])
+    signal_idx = statement.signal_idx
+    forecast_idx = statement.idx(['riktkurs'])
 
     if len(direction_idx) != 1 or len(till_idx) != 1 or len(forecast_idx) > 1 or len(signal_idx) != 1:
         return None
@@ -187,16 +263,17 @@ def extract_simple(text: str, date: datetime.date):
     return forecast
 
 
-def extract_bn(in_str: str, date: datetime.date):
+def extract_bn(in_str: str, date: datetime.date, statement: Statement = None):
     # Morgan Stanley sänker riktkursen för Lundin Energy till 245 kronor (325), upprepar jämvikt - BN
     # Deutsche Bank höjer riktkursen för Boliden till 250 kronor från 235 kronor. Rekommendationen köp upprepas. Det framgår av ett marknadsbrev.
     # Pareto Securities höjer riktkursen för investmentbolaget Kinnevik till 290 kronor från 262 kronor, enligt en ny analys.
-    tokens = tokenize(in_str)
-    direction_idx = idx_in_list(tokens, text_to_direction.keys())
-    for_idx = idx_in_list(tokens, ['för'])
-    till_idx = idx_in_list(tokens, ['till'])
-    fran_idx = idx_in_list(tokens, ['från'])
-    signal_idx = idx_in_list(tokens, text_to_signal.keys())
+    statement = statement or Statement(in_str)
+    tokens = statement.tokens
+    direction_idx = statement.direction_idx
+    for_idx = statement.idx(['för'])
+    till_idx = statement.idx(['till'])
+    fran_idx = statement.idx(['från'])
+    signal_idx = statement.signal_idx
 
     if len(direction_idx) == 0 or len(till_idx) == 0 or len(for_idx) == 0:
         return None
@@ -207,7 +284,7 @@ def extract_bn(in_str: str, date: datetime.date):
     prev_signal = Signal.UNKNOWN
     if len(signal_idx) > 0:
         signal = Signal.from_text(tokens[signal_idx[0]])
-        if 'upprepar' in tokens or 'upprepas' in tokens:
+        if 'upprepar' in statement or 'upprepas' in statement:
             prev_signal = signal
         elif len(tokens) > signal_idx[0] + 1:
             prev_signal_candidate = tokens[signal_idx[0] + 1]
@@ -243,12 +320,13 @@ def extract_bn(in_str: str, date: datetime.date):
     return forecast
 
 
-def extract_no_analyst(text: str, date: datetime.date):
+def extract_no_analyst(text: str, date: datetime.date, statement: Statement = None):
     # Castellum höjs sitt behåll (sälj), med riktkurs 165 kronor (200)
-    tokens = tokenize(text)
-    direction_idx = single_idx_in_list(tokens, text_to_direction.keys())
-    sitt_idx = single_idx_in_list(tokens, ['sitt'])
-    riktkurs_idx = single_idx_in_list(tokens, ['riktkurs'])
+    statement = statement or Statement(text)
+    tokens = statement.tokens
+    direction_idx = statement.single_idx(text_to_direction.keys())
+    sitt_idx = statement.single_idx(['sitt'])
+    riktkurs_idx = statement.single_idx(['riktkurs'])
 
     if not(direction_idx < sitt_idx < riktkurs_idx):
         return None
@@ -279,11 +357,12 @@ def extract_no_analyst(text: str, date: datetime.date):
     return forecast
 
 
-def extract_inled(text: str, date: datetime.date):
+def extract_inled(text: str, date: datetime.date, statement: Statement = None):
     # BTIG inleder bevakning på Tripadvisor med rekommendationen neutral.
-    tokens = tokenize(text)
-    inleder_idx = idx_in_list(tokens, ['inleder'])
-    med_idx = idx_in_list(tokens, ['med'])
+    statement = statement or Statement(text)
+    tokens = statement.tokens
+    inleder_idx = statement.idx(['inleder'])
+    med_idx = statement.idx(['med'])
 
     if len(inleder_idx) != 1 or len(med_idx) != 1:
         return None
@@ -304,13 +383,14 @@ def extract_inled(text: str, date: datetime.date):
     return forecast
 
 
-def extract_bloomberg(text: str, date: datetime.date):
+def extract_bloomberg(text: str, date: datetime.date, statement: Statement = None):
     # "Goldman Sachs & Co sänker sin rekommendation för Outokumpu till neutral från köp."
-    tokens = tokenize(text)
-    sin_idx = single_idx_in_list(tokens, ['sin'])
-    for_idx = single_idx_in_list(tokens, ['för'])
-    till_idx = single_idx_in_list(tokens, ['till'])
-    fran_idx = single_idx_in_list(tokens, ['från'])
+    statement = statement or Statement(text)
+    tokens = statement.tokens
+    sin_idx = statement.single_idx(['sin'])
+    for_idx = statement.single_idx(['för'])
+    till_idx = statement.single_idx(['till'])
+    fran_idx = statement.single_idx(['från'])
 
     if not (0 < sin_idx < for_idx < till_idx < fran_idx):
         return None
@@ -329,15 +409,16 @@ def extract_bloomberg(text: str, date: datetime.date):
     return forecast
 
 
-def extract_motivated_value(text: str, date: datetime.date):
+def extract_motivated_value(text: str, date: datetime.date, statement: Statement = None):
     # "Redeye höjer motiverat värde för Systemair till 168 kronor (155)."
     # Redeye höjer sitt motiverade värde i basscenariot för bettingbolaget Enlabs till 30 kronor, från tidigare 29 kronor.
     # Might not be needed anymore after extract_bn generalised.
-    tokens = tokenize(text)
-    motiverat_idx = single_idx_in_list(tokens, ['motiverat'])
-    varde_idx = single_idx_in_list(tokens, ['värde'])
-    for_idx = single_idx_in_list(tokens, ['för',])
-    till_idx = single_idx_in_list(tokens, ['till'])
+    statement = statement or Statement(text)
+    tokens = statement.tokens
+    motiverat_idx = statement.single_idx(['motiverat'])
+    varde_idx = statement.single_idx(['värde'])
+    for_idx = statement.single_idx(['för'])
+    till_idx = statement.single_idx(['till'])
 
     if motiverat_idx+1 != varde_idx:
         return None
@@ -363,30 +444,105 @@ def extract_motivated_value(text: str, date: datetime.date):
     return forecast
 
 
+class Extractor(NamedTuple):
+    name: str
+    function: Callable
+    # Each group must have at least one of its tokens in a statement for the extractor to be able to match.
+    triggers: List[Collection[str]]
+
+    def applies_to(self, statement: Statement) -> bool:
+        return all(statement.has_any(group) for group in self.triggers)
+
+
+# Extractors in the order they are tried, the first one matching a statement is used.
+extractors = [
+    Extractor('simple', extract_simple, [text_to_direction.keys(), ['till'], text_to_signal.keys()]),
+    Extractor('bloomberg', extract_bloomberg, [['sin'], ['för'], ['till'], ['från']]),
+    Extractor('bn', extract_bn, [text_to_direction.keys(), ['för'], ['till']]),
+    Extractor('no_analyst', extract_no_analyst, [['riktkurs']]),
+    Extractor('inled', extract_inled, [['inleder'], ['med']]),
+    Extractor('motivated_value', extract_motivated_value, [['motiverat', 'värde']]),
+]
+
+
+def canonical_name(forecast: model.Forecast) -> model.Forecast:
+    """Forecast with the analyst and company names it is stored as."""
+    analyst = canonical_analyst(forecast.analyst)
+    company = canonical_company(forecast.company)
+    if analyst == forecast.analyst and company == forecast.company:
+        return forecast
+    return forecast._replace(analyst=analyst, company=company)
+
+
+def _extractor_versions() -> Dict[str, str]:
+    # A statement reaches an extractor only if all extractors before it fail, so the version of an
+    # extractor covers the extractors before it as well as the shared tokenization and vocabulary.
+    shared = [inspect.getsource(o) for o in [to_float,
+                                             is_parentheses_enclosed,
+                                             merge_parenthesis_tokens,
+                                             TermMatcher,
+                                             is_numeric,
+                                             merge_number_tokens,
+                                             tokenize_tagged,
+                                             Statement,
+                                             Extractor]]
+    shared += [repr(sorted((k, v.name) for k, v in text_to_signal.items())),
+               repr(sorted((k, v.name) for k, v in text_to_direction.items())),
+               repr(sorted(currencies.items())),
+               repr(sorted(analyst_aliases.items())),
+               repr(sorted(company_aliases.items())),
+               inspect.getsource(_canonical),
+               inspect.getsource(canonical_analyst),
+               inspect.getsource(canonical_company),
+               inspect.getsource(canonical_name)]
+    md5 = hashlib.md5('\n'.join(shared).encode('utf-8'))
+    versions = {}
+    for e in extractors:
+        md5.update(f"{e.name} {sorted(map(sorted, e.triggers))}\n{inspect.getsource(e.function)}".encode('utf-8'))
+        versions[e.name] = md5.hexdigest()[:12]
+    return versions
+
+
+extractor_versions = _extractor_versions()
+# Version stored for statements no extractor matched, they are only extracted again when some extractor changes.
+failed_version = 'failed@' + extractor_versions[extractors[-1].name]
+
+
+def extractor_version(name: Optional[str]) -> Optional[str]:
+    """Fingerprint of the code behind an extractor, changes whenever the result of the extractor might."""
+    return failed_version if name is None else extractor_versions.get(name)
+
+
+def current_versions() -> List[str]:
+    """Extractor and version of forecasts extracted by the current code, as 'extractor:version'."""
+    return [f"{n}:{v}" for n, v in extractor_versions.items()] + [f":{failed_version}"]
+
+
 def extract_forecast(text: str, date: datetime.date):
     logging.debug(f"Extracting: {text}")
-    result = extract_simple(text, date)
-    if result is not None:
-        return result
-    result = extract_bloomberg(text, date)
-    if result is not None:
-        return result
-    result = extract_bn(text, date)
-    if result is not None:
-        return result
-    result = extract_no_analyst(text, date)
-    if result is not None:
-        return result
-    result = extract_inled(text, date)
-    if result is not None:
-        return result
-    result = extract_motivated_value(text, date)
-    if result is not None:
-        return result
+    # With metrics, tokenization and each extractor that applies to the statement are recorded.
+    measured = metrics.enabled
+    start = time.perf_counter() if measured else 0.0
+    statement = Statement(text)
+    if measured:
+        metrics.observe('stockrec_tokenize_seconds', time.perf_counter() - start)
+    for extractor in extractors:
+        if not extractor.applies_to(statement):
+            continue
+        if measured:
+            result = metrics.record('stockrec_extractor', extractor.function, text, date, statement,
+                                    extractor=extractor.name)
+        else:
+            result = extractor.function(text, date, statement)
+        if result is not None:
+            return canonical_name(result)
+    if measured:
+        metrics.inc('stockrec_extract_failures_total')
     return model.Forecast(raw=text, date=date)
 
 
-def extract_forecasts(statements, date: datetime.date):
+def extract_forecasts(statements, date: datetime.date, compact: bool = False):
+    """Extract forecasts from statements, as CompactForecast if compact is set."""
     no_processed = 0
     no_failed = 0
     for statement in statements:
@@ -395,6 +551,35 @@ def extract_forecasts(statements, date: datetime.date):
         if forecast.extractor is None:
             no_failed += 1
             logging.warning(f"Could not extract: {forecast.raw}")
-        yield forecast
+        yield CompactForecast(forecast) if compact else forecast
+    if no_processed == 0:
+        return
     percent = int(100*float(no_failed)/float(no_processed))
     logging.info(f"Of total {no_processed} forecasts, {no_failed}({percent}%) could not be parsed.")
+
+
+class RefreshResult(NamedTuple):
+    processed: int
+    changed: List[model.Forecast]
+    unchanged: List[model.Forecast]
+    failed: List[str]
+
+
+def refresh_forecasts(forecasts: List[model.Forecast], keep_unchanged: bool = False) -> RefreshResult:
+    """
+    Extract stored forecasts again. Returns the forecasts that changed, the ones that did not if keep_unchanged
+    is set, and the statements that could not be extracted. Forecasts that could not be extracted are among the
+    changed or unchanged as well, so they are stored with the version they failed at.
+    """
+    changed = []
+    unchanged = []
+    failed = []
+    for f in forecasts:
+        new_f = extract_forecast(f.raw, f.date)
+        if new_f.extractor is None:
+            failed.append(f.raw)
+        if new_f != f:
+            changed.append(new_f)
+        elif keep_unchanged:
+            unchanged.append(new_f)
+    return RefreshResult(len(forecasts), changed, unchanged, failed)
@@ -1,10 +1,22 @@
+import bisect
+import collections
 import datetime
+import glob
+import gzip
+import hashlib
+import json
 import logging
-from typing import Optional, List
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
+from typing import Optional, List, NamedTuple, Tuple, Iterator
 
 import requests
+import requests.adapters
 from bs4 import BeautifulSoup
 
+from stockrec import metrics
 from stockrec.extract import extract_forecast, extract_forecasts
 
 isoweekday_to_weekday = {1: 'mandagens',
@@ -20,47 +32,410 @@ def weekday_str(date: datetime.date) -> str:
     return isoweekday_to_weekday[date.isoweekday()]
 
 
-def retrieve_html(date: datetime.date, url=None) -> str:
-    # TODO: Refactor to handle many urls
-    if url is None:
-        url = f"https://www.avanza.se/placera/redaktionellt/{date.strftime('%Y/%m/%d')}/{weekday_str(date)}-alla-nya-aktierekar.html"
-    logging.debug(f"Fetching forecast information from: {url}")
-    response = requests.get(url)
-    if response.status_code == 200:
-        logging.info(f"Using forecast information from: {url}")
-        return response.text
-    url = f"https://www.avanza.se/placera/redaktionellt/{date.strftime('%Y/%m/%d')}/har-ar-{weekday_str(date)}-alla-aktierekar.html"
-    logging.debug(f"Fetching forecast information from: {url}")
-    response = requests.get(url)
-    if response.status_code == 200:
-        logging.info(f"Using forecast information from: {url}")
-        return response.text
-    url = f"https://www.avanza.se/placera/redaktionellt/{date.strftime('%Y/%m/%d')}/{weekday_str(date)}-nya-aktierekar.html"
-    logging.debug(f"Fetching forecast information from: {url}")
-    response = requests.get(url)
-    if response.status_code == 200:
-        logging.info(f"Using forecast information from: {url}")
-        return response.text
-    return None
-
-
-def get_statements(html: str) -> List:
+url_templates = [
+    "https://www.avanza.se/placera/redaktionellt/{date:%Y/%m/%d}/{weekday}-alla-nya-aktierekar.html",
+    "https://www.avanza.se/placera/redaktionellt/{date:%Y/%m/%d}/har-ar-{weekday}-alla-aktierekar.html",
+    "https://www.avanza.se/placera/redaktionellt/{date:%Y/%m/%d}/{weekday}-nya-aktierekar.html",
+]
+
+
+def candidate_urls(date: datetime.date) -> List[str]:
+    return [t.format(date=date, weekday=weekday_str(date)) for t in url_templates]
+
+
+class CachedPage(NamedTuple):
+    html: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class HtmlCache:
+    """
+    Gzip compressed on-disk cache of fetched pages keyed by url and date. The least recently used pages are
+    evicted when the cache grows above max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._size = sum(os.path.getsize(p) for p in glob.glob(os.path.join(path, '*.html.gz')))
+
+    def _base(self, url: str, date: datetime.date) -> str:
+        key = hashlib.sha256(f"{date.isoformat()} {url}".encode('utf-8')).hexdigest()
+        return os.path.join(self._path, key)
+
+    def get(self, url: str, date: datetime.date) -> Optional[CachedPage]:
+        base = self._base(url, date)
+        try:
+            with open(base + '.json', 'r') as f:
+                meta = json.load(f)
+            with gzip.open(base + '.html.gz', 'rt', encoding='utf-8') as f:
+                html = f.read()
+            os.utime(base + '.html.gz')
+        except (OSError, ValueError):
+            return None
+        return CachedPage(html, meta.get('etag'), meta.get('last_modified'))
+
+    def put(self, url: str, date: datetime.date, page: CachedPage):
+        base = self._base(url, date)
+        tmp = f"{base}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            f.write(page.html)
+        size = os.path.getsize(tmp)
+        with self._lock:
+            if os.path.exists(base + '.html.gz'):
+                self._size -= os.path.getsize(base + '.html.gz')
+            os.replace(tmp, base + '.html.gz')
+            with open(base + '.json', 'w') as f:
+                json.dump({'url': url,
+                           'date': date.isoformat(),
+                           'etag': page.etag,
+                           'last_modified': page.last_modified}, f)
+            self._size += size
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _evict(self):
+        pages = sorted(glob.glob(os.path.join(self._path, '*.html.gz')), key=os.path.getmtime)
+        for p in pages:
+            if self._size <= self._max_bytes:
+                break
+            self._size -= os.path.getsize(p)
+            for f in [p, p[:-len('.html.gz')] + '.json']:
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+            logging.debug(f"Evicted {p} from cache.")
+
+
+class TemplateIndex:
+    """
+    Persistent record of which url template served the page of each date, or that a date had no page at
+    all. Neighbouring dates are assumed to use the same template as the closest known date.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._dates = []
+        self._dirty = False
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for date, template in json.load(f).items():
+                    self._templates[datetime.date.fromisoformat(date)] = template
+            self._dates = sorted(d for d, t in self._templates.items() if t is not None)
+
+    def has_no_page(self, date: datetime.date) -> bool:
+        return date in self._templates and self._templates[date] is None
+
+    def guess(self, date: datetime.date) -> Optional[int]:
+        with self._lock:
+            if self._templates.get(date) is not None:
+                return self._templates[date]
+            idx = bisect.bisect_left(self._dates, date)
+            neighbours = self._dates[max(idx - 1, 0):idx + 1]
+            if len(neighbours) == 0:
+                return None
+            return self._templates[min(neighbours, key=lambda d: abs((d - date).days))]
+
+    def record(self, date: datetime.date, template: Optional[int]):
+        with self._lock:
+            if date in self._templates and self._templates[date] == template:
+                return
+            if self._templates.get(date) is not None:
+                self._dates.remove(date)
+            self._templates[date] = template
+            if template is not None:
+                bisect.insort(self._dates, date)
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp = f"{self._path}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump({d.isoformat(): t for d, t in sorted(self._templates.items())}, f)
+            os.replace(tmp, self._path)
+            self._dirty = False
+
+
+# Statuses meaning there is no page at a url, any other status than these and 200 is an error.
+_no_page_statuses = (404, 410)
+
+
+class Fetcher:
+    """
+    Fetch forecast pages over a pool of keep-alive connections. All candidate urls for a date are probed
+    concurrently and the first one in template order answering 200 is used.
+
+    With a cache, pages of past dates are considered immutable and served without touching the network,
+    while pages of today are revalidated with a conditional GET. With a template index, the template
+    expected for a date is tried alone before the others are probed, and past dates known to lack a page
+    are skipped. A date is only known to lack a page when all candidate urls answered 404 or 410, other
+    failures raise and are retried on the next run.
+    """
+
+    def __init__(self,
+                 pool_size: int = len(url_templates),
+                 timeout: float = 10.0,
+                 cache: HtmlCache = None,
+                 index: TemplateIndex = None):
+        self._timeout = timeout
+        self._cache = cache
+        self._index = index
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def close(self):
+        if self._index is not None:
+            self._index.save()
+        self._executor.shutdown(wait=True)
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _get(self, url: str, date: datetime.date) -> Optional[str]:
+        cached = self._cache.get(url, date) if self._cache is not None else None
+        headers = {}
+        if cached is not None:
+            if cached.etag is not None:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified is not None:
+                headers['If-Modified-Since'] = cached.last_modified
+        logging.debug(f"Fetching forecast information from: {url}")
+        response = self._session.get(url, headers=headers, timeout=self._timeout)
+        if response.status_code == 304 and cached is not None:
+            return cached.html
+        if response.status_code == 200:
+            if self._cache is not None:
+                self._cache.put(url, date, CachedPage(response.text,
+                                                      response.headers.get('ETag'),
+                                                      response.headers.get('Last-Modified')))
+            return response.text
+        if response.status_code in _no_page_statuses:
+            return None
+        # Other statuses, like 429 or 503, say nothing about whether the page exists.
+        raise requests.HTTPError(f"Got status {response.status_code} from {url}", response=response)
+
+    def _cached_html(self, urls: List[str], date: datetime.date) -> Optional[Tuple[int, str]]:
+        if self._cache is None or date >= datetime.date.today():
+            return None
+        for idx, url in enumerate(urls):
+            cached = self._cache.get(url, date)
+            if cached is not None:
+                logging.info(f"Using cached forecast information from: {url}")
+                if metrics.enabled:
+                    metrics.inc('stockrec_fetch_total', variant=str(idx), result='cached')
+                return idx, cached.html
+        return None
+
+    def _fetch(self, url: str, date: datetime.date, variant: str) -> Optional[str]:
+        if not metrics.enabled:
+            return self._get(url, date)
+        return metrics.record('stockrec_fetch', self._get, url, date, variant=variant)
+
+    def _probe(self, urls: List[str], candidates: List[int], date: datetime.date,
+               custom: bool = False) -> Optional[Tuple[int, str]]:
+        # Each URL template is a variant in the metrics, a URL given by the user is 'custom'.
+        futures = {self._executor.submit(self._fetch, urls[idx], date, 'custom' if custom else str(idx)): idx
+                   for idx in candidates}
+        ordered = sorted(futures, key=futures.get)
+        pages = {}
+        error = None
+        for future in as_completed(futures):
+            try:
+                pages[future] = future.result()
+            except requests.RequestException as e:
+                pages[future] = None
+                error = e
+            # The first template answering 200 in template order wins, whichever answers first, so the
+            # page used for a date does not depend on timing.
+            for f in ordered:
+                if f not in pages:
+                    break
+                if pages[f] is not None:
+                    for other in futures:
+                        other.cancel()
+                    logging.info(f"Using forecast information from: {urls[futures[f]]}")
+                    return futures[f], pages[f]
+        if error is not None:
+            raise error
+        return None
+
+    @metrics.instrumented('stockrec_retrieve_html')
+    def retrieve_html(self, date: datetime.date, url=None) -> Optional[str]:
+        if url is not None:
+            # A given url is tried first, the url templates are still tried if it has no page.
+            result = self._cached_html([url], date) or self._probe([url], [0], date, custom=True)
+            if result is not None:
+                return result[1]
+            logging.info(f"No forecast page at {url}, trying the url templates.")
+        past = date < datetime.date.today()
+        if self._index is not None and past and self._index.has_no_page(date):
+            logging.info(f"Skipping {date}, known to have no forecast page.")
+            return None
+        urls = candidate_urls(date)
+        candidates = list(range(len(urls)))
+        result = self._cached_html(urls, date)
+        if result is None and self._index is not None:
+            guess = self._index.guess(date)
+            if guess is not None:
+                result = self._probe(urls, [guess], date)
+                candidates.remove(guess)
+        if result is None:
+            result = self._probe(urls, candidates, date)
+        if self._index is not None and (result is not None or past):
+            self._index.record(date, result[0] if result is not None else None)
+        return result[1] if result is not None else None
+
+
+_default_fetcher = None
+
+
+def default_fetcher() -> Fetcher:
+    global _default_fetcher
+    if _default_fetcher is None:
+        _default_fetcher = Fetcher()
+    return _default_fetcher
+
+
+def retrieve_html(date: datetime.date, url=None) -> Optional[str]:
+    return default_fetcher().retrieve_html(date, url)
+
+
+_statement_container = 'rich-text text parbase section'
+_chunk_size = 64 * 1024
+
+
+class _StatementParser(HTMLParser):
+    """
+    Incremental parser collecting the text of <p> elements in the first statement container. Text of a
+    paragraph is available as soon as its outermost <p> is closed, the rest of the document is ignored.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.done = False
+        self.texts = collections.deque()
+        self._inside = False
+        self._div_depth = 0
+        self._open = []
+        self._group = []
+
+    @property
+    def found(self) -> bool:
+        """True if the statement container was found."""
+        return self._inside
+
+    def close(self):
+        """Parse what is left of the document. Text of paragraphs that were never closed is added to texts."""
+        super().close()
+        self._flush()
+
+    def _flush(self):
+        self.texts.extend(''.join(b) for b in self._group)
+        self._open = []
+        self._group = []
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if not self._inside:
+            if tag == 'div' and ' '.join((dict(attrs).get('class') or '').split()) == _statement_container:
+                self._inside = True
+                self._div_depth = 1
+        elif tag == 'div':
+            self._div_depth += 1
+        elif tag == 'p':
+            self._open.append([])
+            self._group.append(self._open[-1])
+
+    def handle_endtag(self, tag):
+        if not self._inside or self.done:
+            return
+        if tag == 'p' and len(self._open) > 0:
+            self._open.pop()
+            if len(self._open) == 0:
+                self._flush()
+        elif tag == 'div':
+            self._div_depth -= 1
+            if self._div_depth == 0:
+                self._flush()
+                self.done = True
+
+    def handle_data(self, data):
+        for b in self._open:
+            b.append(data)
+
+
+def _chunks(text: str) -> Iterator[str]:
+    for i in range(0, len(text), _chunk_size):
+        yield text[i:i + _chunk_size]
+
+
+def _stream_texts(html) -> Iterator[str]:
+    parser = _StatementParser()
+    for chunk in (_chunks(html) if isinstance(html, str) else html):
+        parser.feed(chunk)
+        while parser.texts:
+            yield parser.texts.popleft()
+        if parser.done:
+            return
+    parser.close()
+    if not parser.found:
+        logging.warning("No statement container found in page.")
+    yield from parser.texts
+
+
+def _soup_texts(html) -> Iterator[str]:
+    if not isinstance(html, str):
+        html = ''.join(html)
     soup = BeautifulSoup(html, 'html.parser')
-    potential_rec = [p.get_text() for p in soup.find_all('div', 'rich-text text parbase section')[0].find_all('p')]
+    return (p.get_text() for p in soup.find_all('div', _statement_container)[0].find_all('p'))
+
+
+statement_backends = {'stream': _stream_texts,
+                      'soup': _soup_texts}
+
 
-    for p in potential_rec:
+def _statements(html, backend: str) -> Iterator[str]:
+    for p in statement_backends[backend](html):
         statement = p.strip()
         if len(statement) == 0:
             continue
         yield statement
 
 
-def get_forecasts(date=datetime.date.today(), url=None):
+def get_statements(html, backend: str = 'stream') -> Iterator[str]:
+    """
+    Yield the statements of a forecast page. The page is either a string or an iterable of string chunks.
+    The 'stream' backend scans the page incrementally, 'soup' builds a full BeautifulSoup tree. Pages from
+    Fetcher are whole strings since they are cached and passed to worker processes, so their memory still
+    grows with the page, only the parsing does not.
+    """
+    statements = _statements(html, backend)
+    if metrics.enabled:
+        return metrics.timed_iter('stockrec_get_statements', statements, backend=backend)
+    return statements
+
+
+def get_forecasts(date=datetime.date.today(), url=None, fetcher: Fetcher = None):
     logging.info(f"Handle forecasts for {date}.")
-    html = retrieve_html(date, url)
+    html = (fetcher or default_fetcher()).retrieve_html(date, url)
     if html is not None:
         return extract_forecasts(get_statements(html), date)
     else:
         logging.warning(f"Forecast page not found for {date}.")
         return []
-
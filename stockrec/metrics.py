@@ -0,0 +1,179 @@
+import bisect
+import functools
+import json
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Checked before any measurement, so instrumented code costs a single attribute lookup while disabled.
+enabled = False
+
+# Upper bounds in seconds of the latency buckets, doubling from a microsecond to about a minute.
+buckets = [1e-6 * 2 ** n for n in range(27)]
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+def _key(name: str, labels: Dict[str, str]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, quantiles are interpolated within a bucket."""
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            if n > 0 and seen + n >= rank:
+                if idx == len(buckets):
+                    return buckets[-1]
+                lower = buckets[idx - 1] if idx > 0 else 0.0
+                return lower + (buckets[idx] - lower) * (rank - seen) / n
+            seen += n
+        return buckets[-1]
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+def record(name: str, fn: Callable, *args, **labels):
+    """
+    Call fn with args, timing it as name_seconds and counting it in name_total as a hit if it returns a value,
+    a miss if it returns None or a failure if it raises.
+    """
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+    except Exception:
+        observe(name + '_seconds', time.perf_counter() - start, **labels)
+        inc(name + '_total', result='failure', **labels)
+        raise
+    observe(name + '_seconds', time.perf_counter() - start, **labels)
+    inc(name + '_total', result='hit' if result is not None else 'miss', **labels)
+    return result
+
+
+def instrumented(name: str):
+    """Decorator recording calls of a function like record, when metrics are enabled."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            return record(name, functools.partial(fn, *args, **kwargs))
+        return wrapper
+    return decorate
+
+
+def timed_iter(name: str, items: Iterator, **labels) -> Iterator:
+    """Yield items, timing the time spent producing all of them as name_seconds and counting them in name_total."""
+    elapsed = 0.0
+    count = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            count += 1
+            yield item
+    finally:
+        observe(name + '_seconds', elapsed, **labels)
+        inc(name + '_total', count, **labels)
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...], extra: List[Tuple[str, str]] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+def prometheus_text() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(_histograms.items())
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{_labels(labels)} {value}" for (n, labels), value in counters if n == name)
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), h in histograms:
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, h.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels, [('le', repr(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {h.count}")
+                lines.append(f"{name}_sum{_labels(labels)} {h.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {h.count}")
+    return '\n'.join(lines) + '\n'
+
+
+def summary() -> dict:
+    """Counters, and count, total seconds, p50, p95 and p99 of each histogram."""
+    with _lock:
+        return {'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(_counters.items())],
+                'latencies': [{'name': name,
+                               'labels': dict(labels),
+                               'count': h.count,
+                               'seconds': h.sum,
+                               'p50': h.quantile(0.5),
+                               'p95': h.quantile(0.95),
+                               'p99': h.quantile(0.99)}
+                              for (name, labels), h in sorted(_histograms.items())]}
+
+
+def write(prometheus_path: str = None, json_path: str = None):
+    """Write the metrics to a Prometheus text file and/or a JSON summary."""
+    if prometheus_path:
+        with open(prometheus_path, 'w') as f:
+            f.write(prometheus_text())
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(summary(), f, indent=2)
@@ -67,3 +67,20 @@ class Forecast(NamedTuple):
     forecast_price: Optional[Decimal] = None
     prev_forecast_price: Optional[Decimal] = None
     currency: Optional[str] = None
+
+
+class Consensus(NamedTuple):
+    company: str
+    analysts: int = 0
+    # Latest signals of the analysts, counting outperform as buy and underperform as sell.
+    buys: int = 0
+    holds: int = 0
+    sells: int = 0
+    # Forecast prices in the currency most of them are given in.
+    mean_price: Optional[Decimal] = None
+    median_price: Optional[Decimal] = None
+    currency: Optional[str] = None
+    raises: int = 0
+    lowers: int = 0
+    window_days: int = 0
+    updated: Optional[datetime.datetime] = None
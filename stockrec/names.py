@@ -0,0 +1,44 @@
+import functools
+from typing import Dict, Optional
+
+# Known variants of a name, in lower case, and the name they are stored as. Only add variants that certainly
+# are the same analyst or company, a wrong alias merges forecasts that can not be told apart afterwards.
+analyst_aliases = {
+    'bank of america': 'Bank of America Merrill Lynch',
+    'bofa merrill lynch': 'Bank of America Merrill Lynch',
+    'bofa securities': 'Bank of America Merrill Lynch',
+    'merrill lynch': 'Bank of America Merrill Lynch',
+    'goldman sachs': 'Goldman Sachs & Co',
+    'goldman sachs & co.': 'Goldman Sachs & Co',
+    'jpmorgan': 'JP Morgan',
+    'j.p. morgan': 'JP Morgan',
+    'jp morgan cazenove': 'JP Morgan',
+    'kepler': 'Kepler Cheuvreux',
+    'kepler chevreux': 'Kepler Cheuvreux',
+    'abg': 'ABG Sundal Collier',
+    'abg sundal': 'ABG Sundal Collier',
+    'seb equities': 'SEB',
+    'handelsbanken capital markets': 'Handelsbanken',
+    'danske bank markets': 'Danske Bank',
+    'dnb': 'DNB Markets',
+}
+
+company_aliases = {
+}
+
+
+def _canonical(name: str, aliases: Dict[str, str]) -> str:
+    name = ' '.join(name.split())
+    return aliases.get(name.lower(), name)
+
+
+@functools.lru_cache(maxsize=4096)
+def canonical_analyst(name: Optional[str]) -> Optional[str]:
+    """The name an analyst is stored as."""
+    return _canonical(name, analyst_aliases) if name else name
+
+
+@functools.lru_cache(maxsize=16384)
+def canonical_company(name: Optional[str]) -> Optional[str]:
+    """The name a company is stored as."""
+    return _canonical(name, company_aliases) if name else name
@@ -0,0 +1,41 @@
+import collections
+import itertools
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, List
+
+
+_start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def ordered_map(executor: Executor, fn: Callable, items: Iterable, window: int) -> Iterator:
+    """
+    Like executor.map but only keeps window tasks in flight, so huge inputs do not queue up in memory.
+    Results are yielded in the same order as items.
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def process_map(fn: Callable, items: Iterable, workers: int) -> Iterator:
+    """Map fn over items in a pool of worker processes, or in this process if workers is 1. Keeps the order of items."""
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+    # Workers are not forked from this process, which may run other threads holding locks, for instance of logging.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(_start_method)) as executor:
+        yield from ordered_map(executor, fn, items, 2 * workers)
+
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    """Split items into lists of at most size items."""
+    items = iter(items)
+    chunk = list(itertools.islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(items, size))
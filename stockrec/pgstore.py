@@ -1,14 +1,172 @@
+import collections
+import contextlib
+import datetime
 import logging
+import queue
 import ssl
+import threading
 from ssl import SSLContext
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 import pg8000
 
-from stockrec.model import Forecast, Signal, Direction
+from stockrec import metrics
+from stockrec.compact import CompactForecast
+from stockrec.extract import current_versions
+from stockrec.model import Forecast, Signal, Direction, Consensus
+from stockrec.names import analyst_aliases, company_aliases
+from stockrec.parallel import chunked
+from stockrec.storage import Storage, StoreResult
 import os
 
 
-class ForecastStorage:
+class PooledConnection:
+    """A pg8000 connection that keeps the statements it has prepared."""
+
+    max_statements = 64
+
+    def __init__(self, con):
+        self.con = con
+        self._statements = collections.OrderedDict()
+
+    def run(self, sql: str, **params):
+        return self.con.run(sql, **params)
+
+    def run_prepared(self, sql: str, **params):
+        statement = self._statements.pop(sql, None)
+        if statement is None:
+            statement = self.con.prepare(sql)
+            if len(self._statements) >= self.max_statements:
+                self._statements.popitem(last=False)[1].close()
+        self._statements[sql] = statement
+        return statement.run(**params)
+
+
+class Dimension(NamedTuple):
+    table: str
+    alias_table: str
+    id_column: str
+    column: str
+    aliases: Dict[str, str]
+
+
+analyst_dimension = Dimension('analysts', 'analyst_aliases', 'analyst_id', 'analyst', analyst_aliases)
+company_dimension = Dimension('companies', 'company_aliases', 'company_id', 'company', company_aliases)
+
+
+class NameIds:
+    """
+    Ids of analyst or company names, looked up by their lower case alias and kept in an LRU cache for the life
+    of the process. Names without an alias are added to the dimension table when create is set.
+    """
+
+    def __init__(self, dimension: Dimension, size: int = 10000):
+        self._dimension = dimension
+        self._size = size
+        self._ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, con: PooledConnection, names: Iterable[str], create: bool = True) -> Dict[str, int]:
+        ids = {}
+        missing = {}
+        with self._lock:
+            for name in names:
+                alias = name.lower()
+                if alias in self._ids:
+                    self._ids.move_to_end(alias)
+                    ids[name] = self._ids[alias]
+                else:
+                    missing.setdefault(alias, []).append(name)
+        if len(missing) == 0:
+            return ids
+        d = self._dimension
+        found = dict(con.run(f"SELECT alias, {d.id_column} FROM {d.alias_table} WHERE alias = ANY(:aliases)",
+                             aliases=list(missing)))
+        new = [names[0] for alias, names in missing.items() if alias not in found]
+        if create and len(new) > 0:
+            con.run(f"""WITH added AS (
+                          INSERT INTO {d.table} (name) SELECT unnest(CAST(:names AS TEXT[]))
+                          ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+                          RETURNING id, name)
+                        INSERT INTO {d.alias_table} (alias, {d.id_column}) SELECT lower(name), id FROM added
+                        ON CONFLICT (alias) DO NOTHING""",
+                    names=new)
+            found.update(con.run(f"SELECT alias, {d.id_column} FROM {d.alias_table} WHERE alias = ANY(:aliases)",
+                                 aliases=[n.lower() for n in new]))
+        with self._lock:
+            for alias, id in found.items():
+                self._ids[alias] = id
+                self._ids.move_to_end(alias)
+                for name in missing[alias]:
+                    ids[name] = id
+            while len(self._ids) > self._size:
+                self._ids.popitem(last=False)
+        return ids
+
+
+default_consensus_days = 90
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of at most size connections to the database given by the PG_* environment variables.
+    Connections are opened on demand and reused, a connection that failed is closed instead of reused.
+    """
+
+    def __init__(self, size: int = 4):
+        self._user = os.getenv("PG_USER", 'postgres')
+        self._password = os.getenv("PG_PASSWORD", None)
+        self._database = os.getenv("PG_DATABASE", 'postgres')
+        self._host = os.getenv("PG_HOST", 'localhost')
+        self._port = int(os.getenv("PG_PORT", '5432'))
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+        self.partitioned = False
+        self.partitions = set()
+        self.consensus = False
+        self.consensus_days = default_consensus_days
+        self.ids_backfilled = False
+        self.analyst_ids = NameIds(analyst_dimension)
+        self.company_ids = NameIds(company_dimension)
+
+    def _connect(self) -> PooledConnection:
+        ssl_context = SSLContext()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        con = pg8000.connect(self._user, self._host, self._database, self._port, self._password)
+        con.autocommit = True
+        return PooledConnection(con)
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[PooledConnection]:
+        with self._slots:
+            try:
+                con = self._idle.get_nowait()
+            except queue.Empty:
+                con = self._connect()
+            try:
+                yield con
+            except Exception:
+                con.con.close()
+                raise
+            self._idle.put(con)
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool() -> ConnectionPool:
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+
+class ForecastStorage(Storage):
 
     _schema = [
         f"""CREATE TYPE signal AS ENUM ({", ".join(["'"+n.name+"'" for n in list(Signal)])})""",
@@ -32,125 +190,626 @@ class ForecastStorage:
            currency             VARCHAR(10) NULL,
            raw                  TEXT NOT NULL CHECK (raw <> ''),
            extractor            VARCHAR(20) CHECK (extractor <> '' OR extractor IS NULL),
-           md5                  VARCHAR(32) NOT NULL CHECK (length(md5) = 32) PRIMARY KEY,
+           extractor_version    VARCHAR(32) NULL,
+           content_md5          VARCHAR(32) NULL,
+           md5                  VARCHAR(32) NOT NULL CHECK (length(md5) = 32),
            locked               BOOLEAN NOT NULL DEFAULT FALSE,
-           last_updated         TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
-           )""",
+           last_updated         TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+           {primary_key}
+           ) {partitioning}""",
         """CREATE TRIGGER set_update_time 
            BEFORE UPDATE ON forecasts FOR EACH ROW 
            EXECUTE PROCEDURE set_update_time()"""
     ]
 
-    def __init__(self):
-        user = os.getenv("PG_USER", 'postgres')
-        password = os.getenv("PG_PASSWORD", None)
-        self._database = os.getenv("PG_DATABASE", 'postgres')
-        host = os.getenv("PG_HOST", 'localhost')
-        port = int(os.getenv("PG_PORT", '5432'))
-        ssl_context = SSLContext()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-        self._con = pg8000.connect(user, host, self._database, port, password)
-        self._con.autocommit = True
-        self._create_schema()
+    # Applied on every start, so each must be safe to run against an already migrated database.
+    _migrations = [
+        "ALTER TABLE forecasts ADD COLUMN IF NOT EXISTS extractor_version VARCHAR(32) NULL",
+        "ALTER TABLE forecasts ADD COLUMN IF NOT EXISTS content_md5 VARCHAR(32) NULL",
+        "CREATE INDEX IF NOT EXISTS forecasts_date_idx ON forecasts (date, md5)",
+        "CREATE TABLE IF NOT EXISTS analysts (id SERIAL PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+        "CREATE TABLE IF NOT EXISTS companies (id SERIAL PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+        """CREATE TABLE IF NOT EXISTS analyst_aliases (
+           alias                TEXT NOT NULL PRIMARY KEY CHECK (alias = lower(alias)),
+           analyst_id           INTEGER NOT NULL REFERENCES analysts (id)
+           )""",
+        """CREATE TABLE IF NOT EXISTS company_aliases (
+           alias                TEXT NOT NULL PRIMARY KEY CHECK (alias = lower(alias)),
+           company_id           INTEGER NOT NULL REFERENCES companies (id)
+           )""",
+        "ALTER TABLE forecasts ADD COLUMN IF NOT EXISTS analyst_id INTEGER NULL REFERENCES analysts (id)",
+        "ALTER TABLE forecasts ADD COLUMN IF NOT EXISTS company_id INTEGER NULL REFERENCES companies (id)",
+        "CREATE INDEX IF NOT EXISTS forecasts_analyst_id_idx ON forecasts (analyst_id, date)",
+        "CREATE INDEX IF NOT EXISTS forecasts_company_id_idx ON forecasts (company_id, date)",
+        "CREATE TABLE IF NOT EXISTS settings (name TEXT NOT NULL PRIMARY KEY, value TEXT NOT NULL)",
+    ]
 
-    def _has_forecast_table(self) -> bool:
+    # Indexes to read by name, only needed until backfill_ids has set the ids of all forecasts. Dropped by it.
+    _name_indexes = {
+        'forecasts_company_idx': "CREATE INDEX IF NOT EXISTS forecasts_company_idx ON forecasts (company, date)",
+        'forecasts_analyst_idx': "CREATE INDEX IF NOT EXISTS forecasts_analyst_idx ON forecasts (analyst, date)",
+    }
+
+    # Created by rebuild_consensus. Once they exist, store_many keeps them up to date for the companies it
+    # changes forecasts for.
+    _consensus_schema = [
+        """CREATE TABLE IF NOT EXISTS analyst_latest (
+           company              TEXT NOT NULL,
+           analyst              TEXT NOT NULL,
+           date                 DATE NOT NULL,
+           signal               signal NOT NULL,
+           forecast_price       NUMERIC(12,4) NULL,
+           currency             VARCHAR(10) NULL,
+           PRIMARY KEY (company, analyst)
+           )""",
+        """CREATE TABLE IF NOT EXISTS consensus (
+           company              TEXT NOT NULL PRIMARY KEY,
+           analysts             INTEGER NOT NULL,
+           buys                 INTEGER NOT NULL DEFAULT 0,
+           holds                INTEGER NOT NULL DEFAULT 0,
+           sells                INTEGER NOT NULL DEFAULT 0,
+           mean_price           NUMERIC(12,4) NULL,
+           median_price         NUMERIC(12,4) NULL,
+           currency             VARCHAR(10) NULL,
+           raises               INTEGER NOT NULL,
+           lowers               INTEGER NOT NULL,
+           window_days          INTEGER NOT NULL,
+           updated              TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+           )""",
+    ]
+    _consensus_migrations = [
+        "ALTER TABLE consensus ADD COLUMN IF NOT EXISTS buys INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE consensus ADD COLUMN IF NOT EXISTS holds INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE consensus ADD COLUMN IF NOT EXISTS sells INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE consensus ADD COLUMN IF NOT EXISTS currency VARCHAR(10) NULL",
+    ]
+
+    def __init__(self, pool: ConnectionPool = None, partitioned: bool = None, consensus_days: int = None):
+        """
+        Storage using a shared pool of connections. Safe to use from several threads.
+        If partitioned, or PG_PARTITIONED is set, a new forecasts table is partitioned by year on date.
+        Raises and lowers in the consensus are counted over the last consensus_days days when it is rebuilt.
+        Otherwise the window of the stored consensus is kept.
+        """
+        self._pool = pool or default_pool()
+        self._consensus_days = consensus_days
+        if partitioned is None:
+            partitioned = os.getenv("PG_PARTITIONED", '').lower() in ['1', 'true', 'yes']
+        self._create_schema(partitioned)
+
+    @classmethod
+    def _schema_statements(cls, partitioned: bool) -> List[str]:
+        # A partitioned table can only have unique keys including the partition key. Uniqueness of md5 is
+        # then kept by store_many instead.
+        return [s.format(primary_key="PRIMARY KEY (md5, date)" if partitioned else "PRIMARY KEY (md5)",
+                         partitioning="PARTITION BY RANGE (date)" if partitioned else "")
+                if s.startswith("CREATE TABLE") else s
+                for s in cls._schema]
+
+    @staticmethod
+    def _has_forecast_table(con: PooledConnection) -> bool:
         return len(
-            self._con.run(
+            con.run(
                 "SELECT * FROM information_schema.tables WHERE table_name='forecasts'"
             )
         ) == 1
 
-    def _create_schema(self):
-        if not self._has_forecast_table():
-            for s in self._schema:
-                self._con.run(s)
-
-    def store(self, forecast: Forecast):
-        self._con.run("""
-            INSERT INTO forecasts (
-              date,
-              analyst,
-              company,
-              direction,
-              signal, 
-              forecast_price, 
-              prev_signal, 
-              prev_forecast_price, 
-              currency, 
-              raw, 
-              extractor, 
-              md5) 
-            VALUES (
-              :date,
-              :analyst,
-              :company,
-              :direction,
-              :signal, 
-              :forecast_price, 
-              :prev_signal, 
-              :prev_forecast_price, 
-              :currency, 
-              :raw, 
-              :extractor, 
-              md5(:raw)
-            )
-            ON CONFLICT (md5) WHERE locked IS FALSE DO UPDATE SET
-              (date, 
-              analyst, 
-              company, 
-              direction, 
-              signal, 
-              forecast_price, 
-              prev_signal, 
-              prev_forecast_price, 
-              currency, 
-              extractor) = ROW (
-              :date,
-              :analyst,
-              :company,
-              :direction,
-              :signal,
-              :forecast_price,
-              :prev_signal,
-              :prev_forecast_price,
-              :currency,
-              :extractor)""",
-                        date=forecast.date,
-                        analyst=forecast.analyst,
-                        company=forecast.company,
-                        direction=forecast.change_direction.name,
-                        signal=forecast.signal.name,
-                        forecast_price=forecast.forecast_price,
-                        prev_signal=forecast.prev_signal.name,
-                        prev_forecast_price=forecast.prev_forecast_price,
-                        currency=forecast.currency,
-                        raw=forecast.raw,
-                        extractor=forecast.extractor
-                        )
-
-    def fetch_stored_raw(self):
-        records = self._con.run(
-            """SELECT date,
-                      analyst,
-                      company,
-                      direction,
-                      signal,
-                      forecast_price,
-                      prev_signal,
-                      prev_forecast_price,
-                      currency,
-                      extractor,
-                      raw
-                FROM forecasts""")
-        return [Forecast(date=r[0],
-                         analyst=r[1],
-                         company=r[2],
-                         change_direction=Direction[r[3]],
-                         signal=Signal[r[4]],
-                         forecast_price=r[5],
-                         prev_signal=Signal[r[6]],
-                         prev_forecast_price=r[7],
-                         currency=r[8],
-                         extractor=r[9],
-                         raw=r[10]) for r in records]
+    @staticmethod
+    def _is_partitioned(con: PooledConnection) -> bool:
+        return len(con.run("SELECT 1 FROM pg_class WHERE relname = 'forecasts' AND relkind = 'p'")) == 1
+
+    def _create_schema(self, partitioned: bool):
+        with self._pool.schema_lock:
+            if self._pool.schema_ready:
+                return
+            with self._pool.connection() as con:
+                if not self._has_forecast_table(con):
+                    for s in self._schema_statements(partitioned):
+                        con.run(s)
+                for s in self._migrations:
+                    con.run(s)
+                self._pool.ids_backfilled = len(con.run(
+                    "SELECT 1 FROM settings WHERE name = 'ids_backfilled' AND value = 'true'")) == 1
+                if not self._pool.ids_backfilled:
+                    for s in self._name_indexes.values():
+                        con.run(s)
+                for d in [analyst_dimension, company_dimension]:
+                    self._add_aliases(con, d)
+                self._pool.partitioned = self._is_partitioned(con)
+                self._pool.consensus = len(con.run(
+                    "SELECT * FROM information_schema.tables WHERE table_name='consensus'")) == 1
+                if self._pool.consensus:
+                    for s in self._consensus_migrations:
+                        con.run(s)
+                    # Incremental updates keep the window of the last rebuild.
+                    window = con.run("SELECT window_days FROM consensus ORDER BY updated DESC LIMIT 1")
+                    if len(window) > 0:
+                        self._pool.consensus_days = window[0][0]
+            self._pool.schema_ready = True
+
+    @staticmethod
+    def _add_aliases(con: PooledConnection, d: Dimension):
+        # Names and aliases from stockrec.names. Aliases already in the database are kept.
+        con.run(f"""INSERT INTO {d.table} (name) SELECT DISTINCT unnest(CAST(:names AS TEXT[]))
+                    ON CONFLICT (name) DO NOTHING""",
+                names=list(d.aliases.values()))
+        con.run(f"""INSERT INTO {d.alias_table} (alias, {d.id_column})
+                    SELECT a.alias, t.id
+                    FROM unnest(CAST(:aliases AS TEXT[]), CAST(:names AS TEXT[])) AS a (alias, name)
+                    JOIN {d.table} t ON t.name = a.name
+                    UNION
+                    SELECT lower(t.name), t.id FROM {d.table} t WHERE t.name = ANY(:names)
+                    ON CONFLICT (alias) DO NOTHING""",
+                aliases=list(d.aliases.keys()), names=list(d.aliases.values()))
+
+    @staticmethod
+    def _partition_sql(year: int) -> str:
+        return f"""CREATE TABLE IF NOT EXISTS forecasts_{year} PARTITION OF forecasts
+                   FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"""
+
+    def _create_partitions(self, years: Iterable[int]):
+        with self._pool.schema_lock:
+            missing = set(years) - self._pool.partitions
+            if len(missing) == 0:
+                return
+            with self._pool.connection() as con:
+                for year in sorted(missing):
+                    con.run(self._partition_sql(year))
+            self._pool.partitions |= missing
+
+    def migrate_to_partitioned(self):
+        """
+        Move an unpartitioned forecasts table to a new table partitioned by year on date. The old table is
+        kept as forecasts_unpartitioned and can be dropped when the migration is verified.
+        """
+        with self._pool.schema_lock, self._pool.connection() as con:
+            if self._is_partitioned(con):
+                logging.info("Forecasts are already partitioned.")
+                return
+            con.run("START TRANSACTION")
+            try:
+                con.run("ALTER TABLE forecasts RENAME TO forecasts_unpartitioned")
+                for (index,) in con.run("SELECT indexname FROM pg_indexes WHERE tablename = 'forecasts_unpartitioned'"):
+                    con.run(f"ALTER INDEX {index} RENAME TO {index.replace('forecasts', 'forecasts_unpartitioned', 1)}")
+                for s in self._schema_statements(True):
+                    if s.startswith("CREATE TABLE") or s.startswith("CREATE TRIGGER"):
+                        con.run(s)
+                for s in self._migrations:
+                    con.run(s)
+                if not self._pool.ids_backfilled:
+                    for s in self._name_indexes.values():
+                        con.run(s)
+                years = con.run("SELECT DISTINCT CAST(extract(year FROM date) AS INTEGER) FROM forecasts_unpartitioned")
+                for (year,) in years:
+                    con.run(self._partition_sql(year))
+                columns = ", ".join(self._columns + self._id_columns + ['locked', 'last_updated'])
+                con.run(f"INSERT INTO forecasts ({columns}) SELECT {columns} FROM forecasts_unpartitioned")
+            except Exception:
+                con.run("ROLLBACK")
+                raise
+            con.run("COMMIT")
+            self._pool.partitioned = True
+            self._pool.partitions |= {year for (year,) in years}
+        logging.info("Forecasts are partitioned, the old table is kept as forecasts_unpartitioned.")
+
+    # Ids of the analyst and company names. Not part of the content of a forecast as they follow from the names.
+    _id_columns = ['analyst_id', 'company_id']
+    _stored_columns = Storage._columns + _id_columns
+    _stored_updated_columns = Storage._updated_columns + _id_columns
+
+    @classmethod
+    def _upsert_sql(cls, rows: int) -> str:
+        values = ",\n".join("(" + ", ".join(f":{c}_{i}" for c in cls._stored_columns) + ")" for i in range(rows))
+        return f"""
+            INSERT INTO forecasts ({", ".join(cls._stored_columns)})
+            VALUES {values}
+            ON CONFLICT (md5) DO UPDATE SET
+              ({", ".join(cls._stored_updated_columns)}) = ROW ({", ".join("EXCLUDED." + c for c in cls._stored_updated_columns)})
+            WHERE forecasts.locked IS FALSE
+              AND forecasts.content_md5 IS DISTINCT FROM EXCLUDED.content_md5
+            RETURNING xmax = 0, md5, company"""
+
+    _column_types = {'date': 'DATE',
+                     'direction': 'direction',
+                     'signal': 'signal',
+                     'forecast_price': 'NUMERIC',
+                     'prev_signal': 'signal',
+                     'prev_forecast_price': 'NUMERIC',
+                     'analyst_id': 'INTEGER',
+                     'company_id': 'INTEGER'}
+
+    @classmethod
+    def _partitioned_upsert_sql(cls, rows: int) -> List[str]:
+        # Without a unique index on md5 alone, a forecast moving to another date is first moved to its new
+        # date, and rows are not inserted when a locked forecast with the same md5 exists on another date.
+        # Only holds with the md5s locked by store_many, as concurrent inserts do not see each other.
+        columns = ", ".join(cls._stored_columns)
+        values = ",\n".join("(" + ", ".join(f"CAST(:{c}_{i} AS {cls._column_types.get(c, 'TEXT')})"
+                                             for c in cls._stored_columns) + ")" for i in range(rows))
+        move = f"""
+            UPDATE forecasts SET date = v.date
+            FROM (VALUES {values}) AS v ({columns})
+            WHERE forecasts.md5 = v.md5 AND forecasts.date <> v.date AND forecasts.locked IS FALSE"""
+        upsert = f"""
+            INSERT INTO forecasts ({columns})
+            SELECT * FROM (VALUES {values}) AS v ({columns})
+            WHERE NOT EXISTS (SELECT 1 FROM forecasts f WHERE f.md5 = v.md5 AND f.date <> v.date)
+            ON CONFLICT (md5, date) DO UPDATE SET
+              ({", ".join(cls._stored_updated_columns)}) = ROW ({", ".join("EXCLUDED." + c for c in cls._stored_updated_columns)})
+            WHERE forecasts.locked IS FALSE
+              AND forecasts.content_md5 IS DISTINCT FROM EXCLUDED.content_md5
+            RETURNING md5, company"""
+        return [move, upsert]
+
+    @metrics.instrumented('stockrec_store')
+    def store_many(self, forecasts: Iterable[Forecast], batch_size: int = 500) -> StoreResult:
+        """
+        Insert or update forecasts, identified by the md5 of their raw statement, in one transaction.
+        Each batch of at most batch_size rows is sent as a single multi-row statement, smaller if needed to fit
+        the parameters a statement can have. Rows are only written if the content of the forecast changed,
+        locked forecasts are left untouched and counted as unchanged. Partitions for the years of the
+        forecasts are created when needed.
+        """
+        # A statement can not update the same row twice, so rows are unique by md5.
+        rows, no_forecasts = self._unique_rows(forecasts)
+        batches = list(self._batches(rows, batch_size))
+        partitioned = self._pool.partitioned
+        if partitioned:
+            self._create_partitions({row['date'].year for row in rows})
+        in_transaction = len(batches) > 1 or partitioned
+        inserted = 0
+        updated = 0
+        companies = set()
+        with self._pool.connection() as con:
+            analyst_ids = self._pool.analyst_ids.resolve(con, {row['analyst'] for row in rows if row['analyst']})
+            company_ids = self._pool.company_ids.resolve(con, {row['company'] for row in rows if row['company']})
+            for row in rows:
+                row['analyst_id'] = analyst_ids.get(row['analyst'])
+                row['company_id'] = company_ids.get(row['company'])
+            if in_transaction:
+                con.run("START TRANSACTION")
+            try:
+                if partitioned:
+                    # Without a unique index on md5 alone, concurrent writers are serialized per md5 until
+                    # commit, taking the locks in the same order to not deadlock.
+                    con.run("""SELECT pg_advisory_xact_lock(k)
+                               FROM (SELECT DISTINCT hashtext(md5) AS k
+                                     FROM unnest(CAST(:md5s AS TEXT[])) AS md5
+                                     ORDER BY k) AS keys""", md5s=[row['md5'] for row in rows])
+                for batch in batches:
+                    params = {f"{c}_{i}": v for i, row in enumerate(batch) for c, v in row.items()}
+                    stored = {}
+                    if partitioned or self._pool.consensus:
+                        # The company a forecast was stored with, its consensus changes too if the company does.
+                        stored = dict(con.run_prepared("SELECT md5, company FROM forecasts WHERE md5 = ANY(:md5s)",
+                                                       md5s=[row['md5'] for row in batch]))
+                    if partitioned:
+                        move, upsert = self._partitioned_upsert_sql(len(batch))
+                        con.run_prepared(move, **params)
+                        # xmax can not be returned from a partitioned table, inserted rows are told apart
+                        # by their md5 not being stored before.
+                        written = [(md5 not in stored, md5, company)
+                                   for md5, company in con.run_prepared(upsert, **params)]
+                    else:
+                        written = con.run_prepared(self._upsert_sql(len(batch)), **params)
+                    for was_inserted, md5, company in written:
+                        companies.add(company)
+                        companies.add(stored.get(md5))
+                        if was_inserted:
+                            inserted += 1
+                        else:
+                            updated += 1
+            except Exception:
+                if in_transaction:
+                    con.run("ROLLBACK")
+                raise
+            if in_transaction:
+                con.run("COMMIT")
+        companies.discard(None)
+        if self._pool.consensus and len(companies) > 0:
+            self._update_consensus(sorted(companies), self._pool.consensus_days)
+        return StoreResult(inserted, updated, no_forecasts - inserted - updated)
+
+    # The protocol counts bind parameters in 16 bits, which limits the rows of a multi-row statement.
+    _max_params = 65535
+    _max_rows = _max_params // len(_stored_columns)
+
+    @classmethod
+    def _batches(cls, rows: List[dict], batch_size: int) -> Iterator[List[dict]]:
+        # Full batches, then the rest as one statement. The statements prepared for odd sizes are bounded by
+        # the statement cache of the connection.
+        batch_size = min(batch_size, cls._max_rows)
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+    _selected_columns = """date,
+                           analyst,
+                           company,
+                           direction,
+                           signal,
+                           forecast_price,
+                           prev_signal,
+                           prev_forecast_price,
+                           currency,
+                           extractor,
+                           raw,
+                           md5"""
+
+    @staticmethod
+    def _forecast(r) -> Forecast:
+        return Forecast(date=r[0],
+                        analyst=r[1],
+                        company=r[2],
+                        change_direction=Direction[r[3]],
+                        signal=Signal[r[4]],
+                        forecast_price=r[5],
+                        prev_signal=Signal[r[6]],
+                        prev_forecast_price=r[7],
+                        currency=r[8],
+                        extractor=r[9],
+                        raw=r[10])
+
+    @staticmethod
+    def _filters(stale_only: bool = False,
+                 start: datetime.date = None,
+                 stop: datetime.date = None,
+                 extractor: str = None,
+                 failed_only: bool = False,
+                 company: str = None,
+                 company_id: int = None,
+                 ids_backfilled: bool = False) -> Tuple[List[str], dict]:
+        conditions = ["TRUE"]
+        params = {}
+        if stale_only:
+            conditions.append("""locked IS FALSE AND
+                                 coalesce(extractor, '') || ':' || coalesce(extractor_version, '') <> ALL(:current)""")
+            params['current'] = current_versions()
+        if start is not None:
+            conditions.append("date >= :start")
+            params['start'] = start
+        if stop is not None:
+            conditions.append("date <= :stop")
+            params['stop'] = stop
+        if extractor is not None:
+            conditions.append("extractor = :extractor")
+            params['extractor'] = extractor
+        if failed_only:
+            conditions.append("extractor IS NULL")
+        if company is not None and ids_backfilled:
+            # All forecasts with a company have its id, so a company without id has no forecasts.
+            conditions.append("company_id = :company_id" if company_id is not None else "FALSE")
+            if company_id is not None:
+                params['company_id'] = company_id
+        elif company_id is not None:
+            # Forecasts stored before backfill_ids have no company id yet.
+            conditions.append("(company_id = :company_id OR (company_id IS NULL AND company = :company))")
+            params['company_id'] = company_id
+            params['company'] = company
+        elif company is not None:
+            conditions.append("company = :company")
+            params['company'] = company
+        return conditions, params
+
+    def _company_filters(self, company: Optional[str]) -> dict:
+        if company is None:
+            return {}
+        with self._pool.connection() as con:
+            company_id = self._pool.company_ids.resolve(con, [company], create=False).get(company)
+        return {'company': company, 'company_id': company_id, 'ids_backfilled': self._pool.ids_backfilled}
+
+    def fetch_stored_raw(self,
+                         stale_only: bool = False,
+                         start: datetime.date = None,
+                         stop: datetime.date = None,
+                         extractor: str = None,
+                         failed_only: bool = False,
+                         chunk_size: int = 10000,
+                         compact: bool = False) -> Iterator[Forecast]:
+        """
+        Fetch stored forecasts, chunk_size rows at a time ordered by md5, so memory use does not grow with the
+        table. With stale_only, only unlocked forecasts extracted, or failed, by an older version of the
+        extractors are fetched. The other arguments filter on date range, extractor, or
+        forecasts that could not be extracted. With compact, CompactForecast is yielded to save memory.
+        """
+        conditions, params = self._filters(stale_only, start, stop, extractor, failed_only)
+        conditions.append("md5 > :after")
+        params['limit'] = chunk_size
+        sql = f"""SELECT {self._selected_columns}
+                  FROM forecasts
+                  WHERE {" AND ".join(conditions)}
+                  ORDER BY md5
+                  LIMIT :limit"""
+        after = ''
+        while True:
+            with self._pool.connection() as con:
+                records = con.run_prepared(sql, after=after, **params)
+            for r in records:
+                yield CompactForecast(self._forecast(r)) if compact else self._forecast(r)
+            if len(records) < chunk_size:
+                return
+            after = records[-1][11]
+
+    def forecasts_for_company(self,
+                              company: str,
+                              start: datetime.date = None,
+                              stop: datetime.date = None) -> List[Forecast]:
+        """Forecasts for a company, optionally from start date to stop date, ordered by date."""
+        conditions, params = self._filters(start=start, stop=stop, **self._company_filters(company))
+        with self._pool.connection() as con:
+            records = con.run_prepared(
+                f"""SELECT {self._selected_columns}
+                    FROM forecasts
+                    WHERE {" AND ".join(conditions)}
+                    ORDER BY date, md5""",
+                **params)
+        return [self._forecast(r) for r in records]
+
+    def latest_per_analyst(self, company: str = None) -> List[Forecast]:
+        """The latest forecast of each analyst for each company, or for a single company."""
+        conditions, params = self._filters(**self._company_filters(company))
+        with self._pool.connection() as con:
+            records = con.run_prepared(
+                f"""SELECT DISTINCT ON (company, analyst) {self._selected_columns}
+                    FROM forecasts
+                    WHERE {" AND ".join(conditions + ["analyst IS NOT NULL", "company IS NOT NULL"])}
+                    ORDER BY company, analyst, date DESC, md5 DESC""",
+                **params)
+        return [self._forecast(r) for r in records]
+
+    def list_forecasts(self,
+                       after: Optional[Tuple[datetime.date, str]] = None,
+                       limit: int = 100,
+                       start: datetime.date = None,
+                       stop: datetime.date = None,
+                       company: str = None) -> List[Forecast]:
+        """
+        A page of at most limit forecasts ordered by date, following the forecast with page key after.
+        Optionally filtered on a date range and company.
+        """
+        conditions, params = self._filters(start=start, stop=stop, **self._company_filters(company))
+        if after is not None:
+            conditions.append("(date, md5) > (:after_date, :after_md5)")
+            params['after_date'], params['after_md5'] = after
+        with self._pool.connection() as con:
+            records = con.run_prepared(
+                f"""SELECT {self._selected_columns}
+                    FROM forecasts
+                    WHERE {" AND ".join(conditions)}
+                    ORDER BY date, md5
+                    LIMIT :limit""",
+                limit=limit, **params)
+        return [self._forecast(r) for r in records]
+
+    def _update_consensus(self, companies: List[str], days: int):
+        with self._pool.connection() as con:
+            # Forecasts of the companies, found by company id when there is no index on company.
+            in_companies = "company = ANY(:companies)"
+            params = {'companies': companies}
+            if self._pool.ids_backfilled:
+                in_companies += " AND company_id = ANY(:company_ids)"
+                params['company_ids'] = sorted(set(self._pool.company_ids.resolve(con, companies).values()))
+            con.run("START TRANSACTION")
+            try:
+                con.run("DELETE FROM analyst_latest WHERE company = ANY(:companies)", companies=companies)
+                con.run(f"""INSERT INTO analyst_latest (company, analyst, date, signal, forecast_price, currency)
+                           SELECT DISTINCT ON (company, analyst)
+                                  company, analyst, date, signal, forecast_price, currency
+                           FROM forecasts
+                           WHERE {in_companies} AND analyst IS NOT NULL
+                           ORDER BY company, analyst, date DESC, md5 DESC""",
+                        **params)
+                con.run("DELETE FROM consensus WHERE company = ANY(:companies)", companies=companies)
+                # Prices are only averaged in the currency most analysts of a company give them in.
+                con.run(f"""INSERT INTO consensus (company,
+                                                  analysts,
+                                                  buys,
+                                                  holds,
+                                                  sells,
+                                                  mean_price,
+                                                  median_price,
+                                                  currency,
+                                                  raises,
+                                                  lowers,
+                                                  window_days)
+                           SELECT c.company,
+                                  coalesce(l.analysts, 0),
+                                  coalesce(l.buys, 0),
+                                  coalesce(l.holds, 0),
+                                  coalesce(l.sells, 0),
+                                  l.mean_price,
+                                  l.median_price,
+                                  l.currency,
+                                  coalesce(r.raises, 0),
+                                  coalesce(r.lowers, 0),
+                                  CAST(:days AS INTEGER)
+                           FROM (SELECT DISTINCT company FROM forecasts WHERE {in_companies}) c
+                           LEFT JOIN (SELECT a.company,
+                                             count(*) AS analysts,
+                                             count(*) FILTER (WHERE a.signal IN ('BUY', 'OUTPERFORM')) AS buys,
+                                             count(*) FILTER (WHERE a.signal IN ('HOLD', 'NEUTRAL')) AS holds,
+                                             count(*) FILTER (WHERE a.signal IN ('SELL', 'UNDERPERFORM')) AS sells,
+                                             avg(a.forecast_price)
+                                               FILTER (WHERE a.currency IS NOT DISTINCT FROM m.currency) AS mean_price,
+                                             percentile_cont(0.5) WITHIN GROUP (ORDER BY a.forecast_price)
+                                               FILTER (WHERE a.currency IS NOT DISTINCT FROM m.currency) AS median_price,
+                                             m.currency
+                                      FROM analyst_latest a
+                                      LEFT JOIN (SELECT company, mode() WITHIN GROUP (ORDER BY currency) AS currency
+                                                 FROM analyst_latest
+                                                 WHERE company = ANY(:companies) AND forecast_price IS NOT NULL
+                                                 GROUP BY company) m USING (company)
+                                      WHERE a.company = ANY(:companies)
+                                      GROUP BY a.company, m.currency) l USING (company)
+                           LEFT JOIN (SELECT company,
+                                             count(*) FILTER (WHERE direction = 'RAISE') AS raises,
+                                             count(*) FILTER (WHERE direction = 'LOWER') AS lowers
+                                      FROM forecasts
+                                      WHERE {in_companies}
+                                        AND date > current_date - CAST(:days AS INTEGER)
+                                      GROUP BY company) r USING (company)""",
+                        days=days, **params)
+            except Exception:
+                con.run("ROLLBACK")
+                raise
+            con.run("COMMIT")
+
+    def rebuild_consensus(self, chunk_size: int = 1000):
+        """
+        Create the consensus tables if needed and compute them for all companies. Run after refresh, or
+        daily to move the window of raises and lowers. Uses the consensus_days of this storage if given,
+        else the window of the stored consensus, and later updates keep using it.
+        """
+        days = self._consensus_days or self._pool.consensus_days
+        with self._pool.connection() as con:
+            for s in self._consensus_schema + self._consensus_migrations:
+                con.run(s)
+            companies = [c for (c,) in con.run("SELECT DISTINCT company FROM forecasts WHERE company IS NOT NULL")]
+            con.run("DELETE FROM analyst_latest WHERE company <> ALL(:companies)", companies=companies)
+            con.run("DELETE FROM consensus WHERE company <> ALL(:companies)", companies=companies)
+        self._pool.consensus = True
+        self._pool.consensus_days = days
+        for chunk in chunked(sorted(companies), chunk_size):
+            self._update_consensus(chunk, days)
+
+    def consensus(self, company: str = None) -> List[Consensus]:
+        """The current consensus of each company, or of a single company."""
+        conditions, params = self._filters(company=company)
+        with self._pool.connection() as con:
+            records = con.run_prepared(
+                f"""SELECT company, analysts, buys, holds, sells, mean_price, median_price, currency,
+                           raises, lowers, window_days, updated
+                    FROM consensus
+                    WHERE {" AND ".join(conditions)}
+                    ORDER BY company""",
+                **params)
+        return [Consensus(*r) for r in records]
+
+    def backfill_ids(self):
+        """
+        Set the analyst and company ids of forecasts stored before the dimension tables existed, or whose names
+        got a new alias. Names without an alias are added as new analysts and companies. Updates a year at a time.
+        Afterwards forecasts are only read by id, and the indexes on the analyst and company names are dropped.
+        """
+        with self._pool.connection() as con:
+            for d, ids in [(analyst_dimension, self._pool.analyst_ids), (company_dimension, self._pool.company_ids)]:
+                names = con.run(f"SELECT DISTINCT {d.column} FROM forecasts WHERE {d.column} IS NOT NULL")
+                for chunk in chunked((n for (n,) in names), 1000):
+                    ids.resolve(con, chunk)
+            years = con.run("SELECT DISTINCT CAST(extract(year FROM date) AS INTEGER) FROM forecasts ORDER BY 1")
+        for (year,) in years:
+            with self._pool.connection() as con:
+                for d in [analyst_dimension, company_dimension]:
+                    con.run(f"""UPDATE forecasts f SET {d.id_column} = a.{d.id_column}
+                                FROM {d.alias_table} a
+                                WHERE a.alias = lower(f.{d.column})
+                                  AND f.{d.id_column} IS DISTINCT FROM a.{d.id_column}
+                                  AND f.date >= :start AND f.date < :stop""",
+                            start=datetime.date(year, 1, 1), stop=datetime.date(year + 1, 1, 1))
+            logging.info(f"Backfilled analyst and company ids of forecasts from {year}.")
+        with self._pool.connection() as con:
+            con.run("""INSERT INTO settings (name, value) VALUES ('ids_backfilled', 'true')
+                       ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value""")
+            self._pool.ids_backfilled = True
+            for index in self._name_indexes:
+                con.run(f"DROP INDEX IF EXISTS {index}")
+        logging.info(f"Forecasts are read by id, dropped indexes {', '.join(self._name_indexes)}.")
@@ -0,0 +1,143 @@
+import datetime
+import functools
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+from stockrec.archive import extract_page
+from stockrec.fetch import Fetcher
+from stockrec.parallel import ordered_map, process_map
+from stockrec.storage import Storage, StoreResult
+
+
+class PipelineResult(NamedTuple):
+    pages: int = 0
+    failed: int = 0
+    statements: int = 0
+    stored: StoreResult = StoreResult()
+
+
+class _Failed(NamedTuple):
+    error: Exception
+
+
+_end = object()
+
+
+class _Stage(threading.Thread):
+    """Thread putting results into a bounded queue, so a stage waits when the next one falls behind."""
+
+    def __init__(self, name: str, results: Iterator, queue_size: int, stop: threading.Event):
+        super().__init__(name=name, daemon=True)
+        self.queue = queue.Queue(queue_size)
+        self._results = results
+        self._stopped = stop
+
+    def _put(self, item) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self):
+        try:
+            for result in self._results:
+                if not self._put(result):
+                    return
+            self._put(_end)
+        except Exception as e:
+            self._put(_Failed(e))
+        finally:
+            self._results.close()
+
+
+def _drain(q: queue.Queue, stop: threading.Event) -> Iterator:
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _end:
+            return
+        if isinstance(item, _Failed):
+            raise item.error
+        yield item
+
+
+def fetch_page(fetcher: Fetcher, date: datetime.date, url=None) -> Tuple[str, datetime.date, Optional[str]]:
+    """The forecast page of a date as (name, date, html), html is None if there is no page."""
+    return str(date), date, fetcher.retrieve_html(date, url)
+
+
+def _fetch(fetch: Callable, item):
+    try:
+        return fetch(item) + (None,)
+    except Exception as e:
+        return str(item), item, None, e
+
+
+def _fetched(items: Iterable, fetch: Optional[Callable], workers: int) -> Iterator:
+    if fetch is None:
+        for name, date, html in items:
+            yield name, date, html, None
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from ordered_map(executor, functools.partial(_fetch, fetch), items, 2 * workers)
+
+
+def _parse(fetched):
+    name, date, html, error = fetched
+    if error is not None:
+        return name, date, [], error
+    if html is None:
+        logging.warning(f"Forecast page not found for {date}.")
+        return name, date, [], None
+    return extract_page((name, date, html))
+
+
+def run_pipeline(items: Iterable,
+                 storage: Storage,
+                 fetch: Callable = None,
+                 fetch_workers: int = 1,
+                 parse_workers: int = 1,
+                 batch_size: int = 500,
+                 queue_size: int = 16) -> PipelineResult:
+    """
+    Fetch, extract and store forecasts for items, with the stages running concurrently. Pages are fetched by
+    fetch_workers threads calling fetch(item), which returns (name, date, html). Without fetch, items are such
+    pages already. Pages are extracted in parse_workers processes, or a thread if parse_workers is 1. Forecasts
+    are stored in batches of batch_size from this thread, in the order of items. At most queue_size pages wait
+    between two stages.
+    """
+    stop = threading.Event()
+    fetched = _Stage('fetch', _fetched(items, fetch, fetch_workers), queue_size, stop)
+    parsed = _Stage('parse', process_map(_parse, _drain(fetched.queue, stop), parse_workers), queue_size, stop)
+    fetched.start()
+    parsed.start()
+    no_pages = 0
+    no_failed = 0
+    no_statements = 0
+    total = StoreResult()
+    batch = []
+    try:
+        for name, date, forecasts, error in _drain(parsed.queue, stop):
+            no_pages += 1
+            if error is not None:
+                no_failed += 1
+                logging.error(f"Failed to process {name}: {error}")
+                continue
+            no_statements += len(forecasts)
+            logging.info(f"Extracted {len(forecasts)} forecasts from {name}.")
+            batch.extend(forecasts)
+            if len(batch) >= batch_size:
+                total += storage.store_many(batch, batch_size)
+                batch = []
+        total += storage.store_many(batch, batch_size)
+    finally:
+        stop.set()
+    return PipelineResult(no_pages, no_failed, no_statements, total)
@@ -0,0 +1,245 @@
+import datetime
+import sqlite3
+import threading
+from decimal import Decimal
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from stockrec import metrics
+from stockrec.compact import CompactForecast
+from stockrec.extract import current_versions
+from stockrec.model import Forecast, Signal, Direction
+from stockrec.parallel import chunked
+from stockrec.storage import Storage, StoreResult
+
+
+class SqliteStorage(Storage):
+    """
+    Storage in a local SQLite database file, for development and small deployments without a Postgres server.
+    Uses write ahead logging so readers do not block the writer. Safe to use from several threads, writes
+    are serialized.
+    """
+
+    _schema = [
+        """CREATE TABLE IF NOT EXISTS forecasts (
+           date                 TEXT NOT NULL,
+           analyst              TEXT NULL,
+           company              TEXT NULL,
+           direction            TEXT NOT NULL DEFAULT 'UNKNOWN',
+           signal               TEXT NOT NULL DEFAULT 'UNKNOWN',
+           forecast_price       TEXT NULL,
+           prev_signal          TEXT NOT NULL DEFAULT 'UNKNOWN',
+           prev_forecast_price  TEXT NULL,
+           currency             TEXT NULL,
+           raw                  TEXT NOT NULL CHECK (raw <> ''),
+           extractor            TEXT CHECK (extractor <> '' OR extractor IS NULL),
+           extractor_version    TEXT NULL,
+           content_md5          TEXT NULL,
+           md5                  TEXT NOT NULL PRIMARY KEY CHECK (length(md5) = 32),
+           locked               INTEGER NOT NULL DEFAULT 0,
+           last_updated         TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+           )""",
+        "CREATE INDEX IF NOT EXISTS forecasts_date_idx ON forecasts (date, md5)",
+        "CREATE INDEX IF NOT EXISTS forecasts_company_idx ON forecasts (company, date)",
+        "CREATE INDEX IF NOT EXISTS forecasts_analyst_idx ON forecasts (analyst, date)",
+    ]
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._con.execute("PRAGMA journal_mode = WAL")
+        self._con.execute("PRAGMA synchronous = NORMAL")
+        for s in self._schema:
+            self._con.execute(s)
+
+    def close(self):
+        self._con.close()
+
+    def _upsert_sql(self) -> str:
+        return f"""
+            INSERT INTO forecasts ({", ".join(self._columns)})
+            VALUES ({", ".join(":" + c for c in self._columns)})
+            ON CONFLICT (md5) DO UPDATE SET
+              ({", ".join(self._updated_columns)}) = ({", ".join("excluded." + c for c in self._updated_columns)}),
+              last_updated = CURRENT_TIMESTAMP
+            WHERE forecasts.locked = 0
+              AND forecasts.content_md5 IS NOT excluded.content_md5"""
+
+    @staticmethod
+    def _sqlite_row(row: dict) -> dict:
+        # Prices are stored as text to keep them exact.
+        return {c: v.isoformat() if isinstance(v, datetime.date) else
+                   str(v) if isinstance(v, Decimal) else
+                   v for c, v in row.items()}
+
+    @metrics.instrumented('stockrec_store')
+    def store_many(self, forecasts: Iterable[Forecast], batch_size: int = 500) -> StoreResult:
+        """
+        Insert or update forecasts, identified by the md5 of their raw statement, in one transaction.
+        Rows are only written if the content of the forecast changed, locked forecasts are left untouched
+        and counted as unchanged.
+        """
+        rows, no_forecasts = self._unique_rows(forecasts)
+        inserted = 0
+        updated = 0
+        with self._lock:
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                for batch in chunked(rows, batch_size):
+                    # Stored state is read in the same transaction, so the counts match what the upsert does.
+                    stored = {md5: (content_md5, locked) for md5, content_md5, locked in self._con.execute(
+                        f"""SELECT md5, content_md5, locked FROM forecasts
+                            WHERE md5 IN ({", ".join("?" * len(batch))})""",
+                        [row['md5'] for row in batch])}
+                    written = []
+                    for row in batch:
+                        if row['md5'] not in stored:
+                            inserted += 1
+                        elif not stored[row['md5']][1] and stored[row['md5']][0] != row['content_md5']:
+                            updated += 1
+                        else:
+                            continue
+                        written.append(self._sqlite_row(row))
+                    self._con.executemany(self._upsert_sql(), written)
+            except Exception:
+                self._con.execute("ROLLBACK")
+                raise
+            self._con.execute("COMMIT")
+        return StoreResult(inserted, updated, no_forecasts - inserted - updated)
+
+    _selected_columns = """date,
+                           analyst,
+                           company,
+                           direction,
+                           signal,
+                           forecast_price,
+                           prev_signal,
+                           prev_forecast_price,
+                           currency,
+                           extractor,
+                           raw,
+                           md5"""
+
+    @staticmethod
+    def _forecast(r) -> Forecast:
+        return Forecast(date=datetime.date.fromisoformat(r[0]),
+                        analyst=r[1],
+                        company=r[2],
+                        change_direction=Direction[r[3]],
+                        signal=Signal[r[4]],
+                        forecast_price=Decimal(r[5]) if r[5] is not None else None,
+                        prev_signal=Signal[r[6]],
+                        prev_forecast_price=Decimal(r[7]) if r[7] is not None else None,
+                        currency=r[8],
+                        extractor=r[9],
+                        raw=r[10])
+
+    @staticmethod
+    def _filters(stale_only: bool = False,
+                 start: datetime.date = None,
+                 stop: datetime.date = None,
+                 extractor: str = None,
+                 failed_only: bool = False,
+                 company: str = None) -> Tuple[List[str], dict]:
+        conditions = ["1"]
+        params = {}
+        if stale_only:
+            current = current_versions()
+            conditions.append(f"""locked = 0 AND
+                                  coalesce(extractor, '') || ':' || coalesce(extractor_version, '') NOT IN
+                                    ({", ".join(f":current_{i}" for i in range(len(current)))})""")
+            params.update({f"current_{i}": v for i, v in enumerate(current)})
+        if start is not None:
+            conditions.append("date >= :start")
+            params['start'] = start.isoformat()
+        if stop is not None:
+            conditions.append("date <= :stop")
+            params['stop'] = stop.isoformat()
+        if extractor is not None:
+            conditions.append("extractor = :extractor")
+            params['extractor'] = extractor
+        if failed_only:
+            conditions.append("extractor IS NULL")
+        if company is not None:
+            conditions.append("company = :company")
+            params['company'] = company
+        return conditions, params
+
+    def _select(self, sql: str, **params) -> List[Forecast]:
+        with self._lock:
+            records = self._con.execute(sql, params).fetchall()
+        return [self._forecast(r) for r in records]
+
+    def fetch_stored_raw(self,
+                         stale_only: bool = False,
+                         start: datetime.date = None,
+                         stop: datetime.date = None,
+                         extractor: str = None,
+                         failed_only: bool = False,
+                         chunk_size: int = 10000,
+                         compact: bool = False) -> Iterator[Forecast]:
+        """
+        Fetch stored forecasts, chunk_size rows at a time ordered by md5. With stale_only, only unlocked
+        forecasts extracted, or failed, by an older version of the extractors are fetched.
+        With compact, CompactForecast is yielded to save memory.
+        """
+        conditions, params = self._filters(stale_only, start, stop, extractor, failed_only)
+        conditions.append("md5 > :after")
+        sql = f"""SELECT {self._selected_columns}
+                  FROM forecasts
+                  WHERE {" AND ".join(conditions)}
+                  ORDER BY md5
+                  LIMIT :limit"""
+        after = ''
+        while True:
+            forecasts = self._select(sql, after=after, limit=chunk_size, **params)
+            yield from (CompactForecast(f) for f in forecasts) if compact else forecasts
+            if len(forecasts) < chunk_size:
+                return
+            after = self.page_key(forecasts[-1])[1]
+
+    def forecasts_for_company(self,
+                              company: str,
+                              start: datetime.date = None,
+                              stop: datetime.date = None) -> List[Forecast]:
+        """Forecasts for a company, optionally from start date to stop date, ordered by date."""
+        conditions, params = self._filters(start=start, stop=stop, company=company)
+        return self._select(f"""SELECT {self._selected_columns}
+                                FROM forecasts
+                                WHERE {" AND ".join(conditions)}
+                                ORDER BY date, md5""",
+                            **params)
+
+    def latest_per_analyst(self, company: str = None) -> List[Forecast]:
+        """The latest forecast of each analyst for each company, or for a single company."""
+        conditions, params = self._filters(company=company)
+        return self._select(f"""SELECT {self._selected_columns}
+                                FROM (SELECT *, row_number() OVER (PARTITION BY company, analyst
+                                                                   ORDER BY date DESC, md5 DESC) AS n
+                                      FROM forecasts
+                                      WHERE {" AND ".join(conditions + ["analyst IS NOT NULL",
+                                                                        "company IS NOT NULL"])})
+                                WHERE n = 1
+                                ORDER BY company, analyst""",
+                            **params)
+
+    def list_forecasts(self,
+                       after: Optional[Tuple[datetime.date, str]] = None,
+                       limit: int = 100,
+                       start: datetime.date = None,
+                       stop: datetime.date = None,
+                       company: str = None) -> List[Forecast]:
+        """
+        A page of at most limit forecasts ordered by date, following the forecast with page key after.
+        Optionally filtered on a date range and company.
+        """
+        conditions, params = self._filters(start=start, stop=stop, company=company)
+        if after is not None:
+            conditions.append("(date, md5) > (:after_date, :after_md5)")
+            params['after_date'] = after[0].isoformat()
+            params['after_md5'] = after[1]
+        return self._select(f"""SELECT {self._selected_columns}
+                                FROM forecasts
+                                WHERE {" AND ".join(conditions)}
+                                ORDER BY date, md5
+                                LIMIT :limit""",
+                            limit=limit, **params)
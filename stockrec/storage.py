@@ -0,0 +1,168 @@
+import abc
+import datetime
+import hashlib
+import os
+from decimal import Decimal
+from typing import Iterable, Iterator, List, Optional, Tuple, NamedTuple
+
+from stockrec.extract import extractor_version
+from stockrec.model import Forecast
+
+
+def raw_md5(raw: str) -> str:
+    """Key of a forecast, same as md5(raw) in a UTF8 database."""
+    return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+class StoreResult(NamedTuple):
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+
+    def __add__(self, other):
+        return StoreResult(self.inserted + other.inserted,
+                           self.updated + other.updated,
+                           self.unchanged + other.unchanged)
+
+
+class Storage(abc.ABC):
+    """
+    Storage of forecasts identified by the md5 of their raw statement. Storing is idempotent, a forecast is
+    only written if its content changed and locked forecasts are never overwritten.
+    """
+
+    _columns = ['date',
+                'analyst',
+                'company',
+                'direction',
+                'signal',
+                'forecast_price',
+                'prev_signal',
+                'prev_forecast_price',
+                'currency',
+                'raw',
+                'extractor',
+                'extractor_version',
+                'content_md5',
+                'md5']
+    _updated_columns = [c for c in _columns if c not in ['raw', 'md5']]
+
+    @classmethod
+    def _row(cls, forecast: Forecast) -> dict:
+        row = {'date': forecast.date,
+               'analyst': forecast.analyst,
+               'company': forecast.company,
+               'direction': forecast.change_direction.name,
+               'signal': forecast.signal.name,
+               'forecast_price': forecast.forecast_price,
+               'prev_signal': forecast.prev_signal.name,
+               'prev_forecast_price': forecast.prev_forecast_price,
+               'currency': forecast.currency,
+               'raw': forecast.raw,
+               'extractor': forecast.extractor,
+               'extractor_version': extractor_version(forecast.extractor),
+               'md5': raw_md5(forecast.raw)}
+        row['content_md5'] = cls._content_md5(row)
+        return row
+
+    @classmethod
+    def _content_md5(cls, row: dict) -> str:
+        values = [row[c] for c in cls._updated_columns if c != 'content_md5']
+        text = '\x1f'.join('' if v is None else
+                            str(v.normalize()) if isinstance(v, Decimal) else
+                            str(v) for v in values)
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _unique_rows(cls, forecasts: Iterable[Forecast]) -> Tuple[List[dict], int]:
+        """Rows of forecasts by md5, the last occurrence of a raw statement wins. Also returns the number of forecasts."""
+        rows = {}
+        no_forecasts = 0
+        for f in forecasts:
+            no_forecasts += 1
+            row = cls._row(f)
+            rows.pop(row['md5'], None)
+            rows[row['md5']] = row
+        return list(rows.values()), no_forecasts
+
+    def store(self, forecast: Forecast) -> StoreResult:
+        return self.store_many([forecast])
+
+    @abc.abstractmethod
+    def store_many(self, forecasts: Iterable[Forecast], batch_size: int = 500) -> StoreResult:
+        """Insert or update forecasts in one transaction."""
+
+    @abc.abstractmethod
+    def fetch_stored_raw(self,
+                         stale_only: bool = False,
+                         start: datetime.date = None,
+                         stop: datetime.date = None,
+                         extractor: str = None,
+                         failed_only: bool = False,
+                         chunk_size: int = 10000,
+                         compact: bool = False) -> Iterator[Forecast]:
+        """
+        Stored forecasts ordered by md5, optionally only stale or failed ones, in a date range or by extractor.
+        As CompactForecast if compact is set.
+        """
+
+    @abc.abstractmethod
+    def forecasts_for_company(self,
+                              company: str,
+                              start: datetime.date = None,
+                              stop: datetime.date = None) -> List[Forecast]:
+        """Forecasts for a company, optionally from start date to stop date, ordered by date."""
+
+    @abc.abstractmethod
+    def latest_per_analyst(self, company: str = None) -> List[Forecast]:
+        """The latest forecast of each analyst for each company, or for a single company."""
+
+    @staticmethod
+    def page_key(forecast: Forecast) -> Tuple[datetime.date, str]:
+        """Key to pass as after to list_forecasts to get the forecasts following this one."""
+        return forecast.date, raw_md5(forecast.raw)
+
+    @abc.abstractmethod
+    def list_forecasts(self,
+                       after: Optional[Tuple[datetime.date, str]] = None,
+                       limit: int = 100,
+                       start: datetime.date = None,
+                       stop: datetime.date = None,
+                       company: str = None) -> List[Forecast]:
+        """A page of at most limit forecasts ordered by date, following the forecast with page key after."""
+
+    def iter_forecasts(self,
+                       start: datetime.date = None,
+                       stop: datetime.date = None,
+                       company: str = None,
+                       chunk_size: int = 10000) -> Iterator[Forecast]:
+        """
+        All forecasts ordered by date, optionally filtered on a date range and company. Read chunk_size at a
+        time with list_forecasts, so memory use does not grow with the table.
+        """
+        after = None
+        while True:
+            forecasts = self.list_forecasts(after, chunk_size, start, stop, company)
+            yield from forecasts
+            if len(forecasts) < chunk_size:
+                return
+            after = self.page_key(forecasts[-1])
+
+
+storage_backends = ['postgres', 'sqlite']
+
+
+def open_storage(url: str = None) -> Storage:
+    """
+    Open the storage given by url, or by STOCKREC_STORAGE if not given. Either 'postgres', configured by the
+    PG_* environment variables, or 'sqlite:<path>' for a database file. Defaults to postgres.
+    """
+    url = url or os.getenv("STOCKREC_STORAGE", 'postgres')
+    backend, _, path = url.partition(':')
+    if backend == 'postgres':
+        from stockrec.pgstore import ForecastStorage
+        return ForecastStorage()
+    if backend == 'sqlite':
+        from stockrec.sqlitestore import SqliteStorage
+        return SqliteStorage(path or 'stockrec.db')
+    raise ValueError(f"Unknown storage {url}, expected one of {', '.join(storage_backends)}.")
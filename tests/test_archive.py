@@ -0,0 +1,56 @@
+import datetime
+import gzip
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from stockrec.archive import date_from_name, read_pages
+
+page = '<div class="rich-text text parbase section"><p>Carnegie höjer Thule till köp (behåll).</p></div>'
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_date_from_name(self):
+        self.assertEqual(datetime.date(2020, 5, 14), date_from_name('2020/05/14/tisdagens-alla-nya-aktierekar.html'))
+        self.assertEqual(datetime.date(2020, 5, 14), date_from_name('pages/page-2020-05-14.html.gz'))
+        self.assertEqual(datetime.date(2020, 5, 14), date_from_name('20200514.htm'))
+        self.assertEqual(datetime.date(2020, 5, 14), date_from_name('2020-13-45/2020_05_14.html'))
+        self.assertIsNone(date_from_name('index.html'))
+
+    def _write(self, name: str, data: bytes):
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def test_directory(self):
+        self._write('2020/05/15/page.html.gz', gzip.compress(page.encode('utf-8')))
+        self._write('2020/05/14/page.html', page.encode('utf-8'))
+        self._write('2020/05/14/notes.txt', b'not a page')
+        self._write('undated.html', page.encode('utf-8'))
+        self.assertEqual([(os.path.join('2020', '05', '14', 'page.html'), datetime.date(2020, 5, 14), page),
+                          (os.path.join('2020', '05', '15', 'page.html.gz'), datetime.date(2020, 5, 15), page)],
+                         list(read_pages(self.path)))
+
+    def test_tarball(self):
+        tarball = os.path.join(self.path, 'pages.tar.gz')
+        with tarfile.open(tarball, 'w:gz') as tar:
+            for name, data in [('2020-05-14.html', page.encode('utf-8')),
+                               ('2020-05-15.html.gz', gzip.compress(page.encode('utf-8'))),
+                               ('readme.txt', b'not a page')]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        self.assertEqual([('2020-05-14.html', datetime.date(2020, 5, 14), page),
+                          ('2020-05-15.html.gz', datetime.date(2020, 5, 15), page)],
+                         list(read_pages(tarball)))
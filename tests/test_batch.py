@@ -0,0 +1,36 @@
+import datetime
+import unittest
+from decimal import Decimal
+
+from stockrec.compact import CompactForecast
+from stockrec.model import Forecast, Signal, Direction
+
+try:
+    import numpy as np
+    from stockrec.batch import ForecastBatch
+except ImportError:
+    np = None
+
+day = datetime.date(2020, 1, 1)
+forecasts = [
+    Forecast(raw='a', date=day, analyst='UBS', company='Vale', signal=Signal.BUY, prev_signal=Signal.HOLD,
+             change_direction=Direction.RAISE, forecast_price=Decimal('110'), prev_forecast_price=Decimal('100')),
+    Forecast(raw='b', date=day + datetime.timedelta(10), analyst='UBS', company='Vale', signal=Signal.HOLD,
+             prev_signal=Signal.BUY, change_direction=Direction.UNCHANGED, forecast_price=Decimal('110')),
+    Forecast(raw='c', date=day + datetime.timedelta(200), analyst='UBS', company='Thule',
+             change_direction=Direction.LOWER),
+    Forecast(raw='d', date=day, company='Thule', signal=Signal.BUY, prev_signal=Signal.SELL,
+             forecast_price=Decimal('3'), prev_forecast_price=Decimal('0')),
+]
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestForecastBatch(unittest.TestCase):
+
+    def test_analytics(self):
+        for batch in [ForecastBatch.from_forecasts(forecasts), ForecastBatch.from_forecasts(map(CompactForecast, forecasts))]:
+            np.testing.assert_allclose([0.1, np.nan, np.nan, np.nan], batch.price_change())
+            self.assertEqual({'Vale': 1, 'Thule': 1}, batch.upgrades_per_company())
+            self.assertEqual({'Vale': 1}, batch.downgrades_per_company())
+            np.testing.assert_allclose([1.0, 0.5, 1.0, np.nan], batch.revision_rates(90))
+            self.assertEqual(['UBS'], batch.analysts)
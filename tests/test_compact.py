@@ -0,0 +1,30 @@
+import datetime
+import pickle
+import unittest
+from decimal import Decimal
+
+from stockrec.compact import CompactForecast
+from stockrec.extract import extract_forecast, refresh_forecasts
+
+
+class TestCompactForecast(unittest.TestCase):
+
+    def test_conversion_is_lossless(self):
+        f = extract_forecast('UBS höjer Vale till köp (neutral), riktkurs 12,50 dollar (13).', datetime.date(2020, 3, 2))
+        for prices in [(f.forecast_price, f.prev_forecast_price),
+                       (Decimal('220.0000'), Decimal('2.2E+2')),
+                       (Decimal('0.00001'), Decimal('1234567890123456789')),
+                       (None, Decimal('-3.5'))]:
+            expected = f._replace(forecast_price=prices[0], prev_forecast_price=prices[1])
+            converted = CompactForecast(expected).to_forecast()
+            self.assertEqual(expected, converted)
+            self.assertEqual([str(p) for p in prices], [str(converted.forecast_price), str(converted.prev_forecast_price)])
+        c = CompactForecast(f)
+        self.assertEqual(c, f)
+        self.assertEqual(c, pickle.loads(pickle.dumps(c)))
+        self.assertIs(c.analyst, CompactForecast(f._replace(analyst=''.join(['U', 'BS']))).analyst)
+
+    def test_refresh_compact_forecasts(self):
+        f = extract_forecast('Carnegie sänker Thule till behåll (köp), riktkurs 220 kronor.', datetime.date(2020, 3, 2))
+        result = refresh_forecasts([CompactForecast(f), CompactForecast(f._replace(company='Tesla'))])
+        self.assertEqual([f], result.changed)
@@ -0,0 +1,52 @@
+import csv
+import datetime
+import os
+import tempfile
+import unittest
+
+from stockrec.export import export_forecasts
+from stockrec.extract import extract_forecast
+from stockrec.sqlitestore import SqliteStorage
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+statements = ['Carnegie sänker Thule till behåll (köp), riktkurs 220 kronor.',
+              'UBS höjer Vale till köp (neutral), riktkurs 12,50 dollar (13).',
+              'Kepler Cheuvreux sänker LVMH till behåll (köp), riktkurs 400 euro.']
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.storage = SqliteStorage(os.path.join(self.dir.name, 'stockrec.db'))
+        dates = [datetime.date(2020, 1, 30), datetime.date(2020, 1, 31), datetime.date(2020, 2, 3)]
+        self.storage.store_many(extract_forecast(s, d) for s, d in zip(statements, dates))
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def test_csv(self):
+        path = os.path.join(self.dir.name, 'forecasts.csv')
+        self.assertEqual(2, export_forecasts(self.storage, path, start=datetime.date(2020, 1, 31), chunk_size=1))
+        with open(path, encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(['Vale', 'LVMH'], [r['company'] for r in rows])
+        self.assertEqual('12.50', rows[0]['forecast_price'])
+
+    @unittest.skipIf(pa is None, "pyarrow is not installed")
+    def test_row_groups_per_month(self):
+        path = os.path.join(self.dir.name, 'forecasts.parquet')
+        self.assertEqual(3, export_forecasts(self.storage, path, chunk_size=2))
+        self.assertEqual(2, pq.ParquetFile(path).num_row_groups)
+        path = os.path.join(self.dir.name, 'forecasts.arrow')
+        export_forecasts(self.storage, path, max_rows_per_group=1)
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            self.assertEqual(3, reader.num_record_batches)
+            self.assertEqual(['Thule', 'Vale', 'LVMH'], reader.read_all().column('company').to_pylist())
@@ -2,8 +2,10 @@ import datetime
 import unittest
 from decimal import Decimal
 
-from stockrec.extract import extract_forecast
-from stockrec.model import Forecast, Direction, Signal
+from stockrec.extract import (Statement, TermMatcher, currencies, extract_forecast, extractors, idx_in_list,
+                              single_idx_in_list, tokenize, tokenize_tagged)
+from stockrec.model import Forecast, Direction, Signal, text_to_direction, text_to_signal
+from stockrec.names import canonical_analyst, canonical_company
 
 
 class TestSimpleExtractor(unittest.TestCase):
@@ -208,4 +210,73 @@ class TestSimpleExtractor(unittest.TestCase):
             self.assertEqual(expected, extract_forecast(s, date=datetime.date.today()))
 
 
+class TestTokenize(unittest.TestCase):
 
+    def test_multi_word_terms(self):
+        self.assertEqual(['RBC', 'höjer', 'Zoom', 'till', 'market perform', '(sector perform)'],
+                         tokenize('RBC höjer Zoom till market perform (sector perform).'))
+
+    def test_trailing_first_word_of_term(self):
+        self.assertEqual(['Nordea', 'Markets', 'höjer', 'till', 'market'],
+                         tokenize('Nordea Markets höjer till market'))
+        self.assertEqual(['sänker', 'market', 'till', 'köp'], tokenize('sänker market till köp'))
+
+    def test_kinds(self):
+        tokens, kinds = tokenize_tagged('UBS höjer Shopify till köp, riktkurs 90 kanadensiska dollar (85)')
+        self.assertEqual(['UBS', 'höjer', 'Shopify', 'till', 'köp', 'riktkurs', '90', 'kanadensiska dollar', '(85)'],
+                         tokens)
+        self.assertEqual([set(), {'direction'}, set(), set(), {'signal'}, set(), set(), {'currency'}, set()],
+                         [set(k) for k in kinds])
+
+    def test_three_word_term(self):
+        matcher = TermMatcher({'signal': ['strong buy', 'strong buy list'], 'currency': ['list']})
+        self.assertEqual((['add', 'strong buy list', 'strong buy', 'strong', 'list'],
+                          [frozenset(), {'signal'}, {'signal'}, frozenset(), {'currency'}]),
+                         matcher.match(['add', 'strong', 'buy', 'list', 'strong', 'buy', 'strong', 'list']))
+
+
+class TestStatement(unittest.TestCase):
+
+    def test_lookups_same_as_token_list(self):
+        for text, _ in TestSimpleExtractor.test_data:
+            statement = Statement(text)
+            tokens = tokenize(text)
+            self.assertEqual(tokens, statement.tokens)
+            for values in [list(text_to_direction), list(text_to_signal), list(currencies), ['till'],
+                           ['riktkurs', 'till', 'för'], ['saknas']]:
+                self.assertEqual(idx_in_list(tokens, values), statement.idx(values))
+                self.assertEqual(single_idx_in_list(tokens, values), statement.single_idx(values))
+                self.assertEqual(len(idx_in_list(tokens, values)) > 0, statement.has_any(values))
+
+
+class TestDispatch(unittest.TestCase):
+
+    def test_same_extractor_as_linear_scan(self):
+        date = datetime.date(2020, 1, 1)
+        texts = [text for text, _ in TestSimpleExtractor.test_data] + [
+            'Inget att se här.',
+            'Carnegie höjer riktkursen för Volvo.',
+            'Nordea inleder bevakning av Atlas Copco.',
+        ]
+        for text in texts:
+            statement = Statement(text)
+            expected = next((e.name for e in extractors if e.function(text, date, statement) is not None), None)
+            self.assertEqual(expected, extract_forecast(text, date).extractor, text)
+
+
+class TestCanonicalNames(unittest.TestCase):
+
+    def test_canonical_names(self):
+        self.assertEqual('Kepler Cheuvreux', canonical_analyst('Kepler'))
+        self.assertEqual('Kepler Cheuvreux', canonical_analyst('KEPLER  Chevreux'))
+        self.assertEqual('Carnegie', canonical_analyst('Carnegie'))
+        self.assertEqual('Volvo B', canonical_company(' Volvo  B '))
+        self.assertIsNone(canonical_company(None))
+
+    def test_extracted_names_are_canonical(self):
+        date = datetime.date(2020, 1, 1)
+        forecast = extract_forecast('Kepler höjer riktkursen för Volvo  B till 200 kronor från 180 kronor, upprepar köp.',
+                                    date)
+        self.assertEqual(('Kepler Cheuvreux', 'Volvo B'), (forecast.analyst, forecast.company))
+        forecast = extract_forecast('Carnegie   Small Cap sänker Thule till behåll (köp), riktkurs 220 kronor.', date)
+        self.assertEqual(('Carnegie Small Cap', 'Thule'), (forecast.analyst, forecast.company))
@@ -0,0 +1,221 @@
+import datetime
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+from stockrec import fetch
+from stockrec.fetch import CachedPage, Fetcher, HtmlCache, TemplateIndex, candidate_urls, get_statements
+
+page = """<html><head><title>Alla nya aktierekar</title>
+<script>var p = "<p>not a statement</p>";</script></head>
+<body>
+<div class="text parbase section"><p>Wrong container.</p></div>
+<div class="rich-text  text parbase
+section">
+  <p>Carnegie sänker Thule till behåll (köp), riktkurs 220&nbsp;kronor.</p>
+  <p>   </p>
+  <p><strong>UBS</strong> höjer Vale till köp (neutral), riktkurs 12 dollar (13).&#160;</p>
+  <div class="inner"><p>Kepler Cheuvreux sänker LVMH till behåll (köp), riktkurs 400 euro.</p></div>
+  <p>Outer <p>Inner statement.</p> tail.</p>
+  <p>Castellum höjs sitt behåll (sälj),<br/> med riktkurs 165 kronor (200)<!-- comment --></p>
+  <p>Unclosed paragraph at end of container.
+</div>
+<div class="rich-text text parbase section"><p>Second container.</p></div>
+</body></html>"""
+
+
+class TestGetStatements(unittest.TestCase):
+
+    def test_stream_backend_same_as_soup(self):
+        expected = list(get_statements(page, backend='soup'))
+        self.assertEqual(7, len(expected))
+        self.assertEqual(expected, list(get_statements(page, backend='stream')))
+
+    def test_stream_backend_small_chunks(self):
+        chunks = [page[i:i + 7] for i in range(0, len(page), 7)]
+        self.assertEqual(list(get_statements(page, backend='soup')), list(get_statements(chunks)))
+
+    def test_stream_stops_after_container(self):
+        fetch._chunk_size = 16
+        try:
+            statements = get_statements(page + '<p>' * 100000)
+            self.assertEqual('Unclosed paragraph at end of container.', list(statements)[-1])
+        finally:
+            fetch._chunk_size = 64 * 1024
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+class FakeSession:
+    """
+    Answers urls from a dict of url to (status, html) or (status, html, headers), 404 for other urls. Records
+    the requests made.
+    """
+
+    def __init__(self, pages, delays=None):
+        self.pages = pages
+        self.delays = delays or {}
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None, timeout=None):
+        with self._lock:
+            self.requests.append((url, dict(headers or {})))
+        time.sleep(self.delays.get(url, 0))
+        return FakeResponse(*self.pages.get(url, (404, '')))
+
+    def close(self):
+        pass
+
+
+def fake_fetcher(session, **kwargs):
+    fetcher = Fetcher(**kwargs)
+    fetcher._session = session
+    return fetcher
+
+
+class TestFetcher(unittest.TestCase):
+    date = datetime.date(2020, 3, 3)
+
+    def test_lowest_template_wins(self):
+        urls = candidate_urls(self.date)
+        session = FakeSession({urls[0]: (200, 'first'), urls[1]: (200, 'second')}, delays={urls[0]: 0.2})
+        with fake_fetcher(session) as fetcher:
+            self.assertEqual('first', fetcher.retrieve_html(self.date))
+
+    def test_given_url_falls_back_to_templates(self):
+        urls = candidate_urls(self.date)
+        session = FakeSession({'http://custom': (200, 'custom'), urls[1]: (200, 'template')})
+        with fake_fetcher(session) as fetcher:
+            self.assertEqual('custom', fetcher.retrieve_html(self.date, 'http://custom'))
+            self.assertEqual('template', fetcher.retrieve_html(self.date, 'http://missing'))
+
+    def test_no_page(self):
+        with fake_fetcher(FakeSession({})) as fetcher:
+            self.assertIsNone(fetcher.retrieve_html(self.date))
+
+
+class TestHtmlCache(unittest.TestCase):
+    date = datetime.date(2020, 3, 3)
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_put_get(self):
+        cache = HtmlCache(self.path)
+        self.assertIsNone(cache.get('http://a', self.date))
+        cache.put('http://a', self.date, CachedPage('<p>a</p>', '"etag"', 'Tue, 03 Mar 2020 08:00:00 GMT'))
+        self.assertEqual(CachedPage('<p>a</p>', '"etag"', 'Tue, 03 Mar 2020 08:00:00 GMT'),
+                         HtmlCache(self.path).get('http://a', self.date))
+        self.assertIsNone(cache.get('http://a', self.date + datetime.timedelta(1)))
+
+    def _page_file(self, cache, url):
+        return cache._base(url, self.date) + '.html.gz'
+
+    def test_evicts_least_recently_used(self):
+        cache = HtmlCache(self.path)
+        cache.put('http://a', self.date, CachedPage('a' * 1000))
+        size = os.path.getsize(self._page_file(cache, 'http://a'))
+        cache = HtmlCache(self.path, max_bytes=2 * size)
+        cache.put('http://b', self.date, CachedPage('b' * 1000))
+        os.utime(self._page_file(cache, 'http://a'), (1000, 1000))
+        os.utime(self._page_file(cache, 'http://b'), (2000, 2000))
+        self.assertIsNotNone(cache.get('http://a', self.date))
+        cache.put('http://c', self.date, CachedPage('c' * 1000))
+        self.assertIsNotNone(cache.get('http://a', self.date))
+        self.assertIsNone(cache.get('http://b', self.date))
+        self.assertIsNotNone(cache.get('http://c', self.date))
+
+    def test_conditional_get(self):
+        today = datetime.date.today()
+        url = candidate_urls(today)[0]
+        cache = HtmlCache(self.path)
+        session = FakeSession({url: (200, 'fresh', {'ETag': '"v1"'})})
+        with fake_fetcher(session, cache=cache) as fetcher:
+            self.assertEqual('fresh', fetcher.retrieve_html(today))
+        self.assertEqual(CachedPage('fresh', '"v1"'), cache.get(url, today))
+        session = FakeSession({url: (304, '')})
+        with fake_fetcher(session, cache=cache) as fetcher:
+            self.assertEqual('fresh', fetcher.retrieve_html(today))
+        self.assertIn((url, {'If-None-Match': '"v1"'}), session.requests)
+
+    def test_past_dates_served_from_cache(self):
+        url = candidate_urls(self.date)[1]
+        cache = HtmlCache(self.path)
+        cache.put(url, self.date, CachedPage('cached'))
+        session = FakeSession({})
+        with fake_fetcher(session, cache=cache) as fetcher:
+            self.assertEqual('cached', fetcher.retrieve_html(self.date))
+        self.assertEqual([], session.requests)
+
+
+class TestTemplateIndex(unittest.TestCase):
+    date = datetime.date(2020, 3, 3)
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'templates.json')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_guess_closest_date(self):
+        index = TemplateIndex(self.path)
+        self.assertIsNone(index.guess(self.date))
+        index.record(datetime.date(2020, 1, 1), 0)
+        index.record(datetime.date(2020, 3, 1), 2)
+        index.record(datetime.date(2020, 3, 2), None)
+        self.assertEqual(2, index.guess(self.date))
+        self.assertEqual(0, index.guess(datetime.date(2019, 6, 1)))
+        self.assertEqual(0, index.guess(datetime.date(2020, 1, 20)))
+        self.assertTrue(index.has_no_page(datetime.date(2020, 3, 2)))
+        self.assertFalse(index.has_no_page(self.date))
+
+    def test_save_and_load(self):
+        index = TemplateIndex(self.path)
+        index.record(self.date, 1)
+        index.record(self.date + datetime.timedelta(1), None)
+        index.save()
+        loaded = TemplateIndex(self.path)
+        self.assertEqual(1, loaded.guess(self.date))
+        self.assertTrue(loaded.has_no_page(self.date + datetime.timedelta(1)))
+
+    def test_guessed_template_tried_alone(self):
+        urls = candidate_urls(self.date)
+        index = TemplateIndex(self.path)
+        index.record(self.date - datetime.timedelta(1), 2)
+        session = FakeSession({urls[2]: (200, 'page')})
+        with fake_fetcher(session, index=index) as fetcher:
+            self.assertEqual('page', fetcher.retrieve_html(self.date))
+        self.assertEqual([urls[2]], [url for url, _ in session.requests])
+
+    def test_missing_page_recorded(self):
+        with fake_fetcher(FakeSession({}), index=TemplateIndex(self.path)) as fetcher:
+            self.assertIsNone(fetcher.retrieve_html(self.date))
+        session = FakeSession({})
+        with fake_fetcher(session, index=TemplateIndex(self.path)) as fetcher:
+            self.assertIsNone(fetcher.retrieve_html(self.date))
+        self.assertEqual([], session.requests)
+
+    def test_server_error_not_recorded(self):
+        urls = candidate_urls(self.date)
+        with fake_fetcher(FakeSession({urls[0]: (503, '')}), index=TemplateIndex(self.path)) as fetcher:
+            self.assertRaises(requests.HTTPError, fetcher.retrieve_html, self.date)
+        session = FakeSession({urls[0]: (200, 'page')})
+        with fake_fetcher(session, index=TemplateIndex(self.path)) as fetcher:
+            self.assertEqual('page', fetcher.retrieve_html(self.date))
+        self.assertEqual(0, TemplateIndex(self.path).guess(self.date))
@@ -0,0 +1,32 @@
+import datetime
+import unittest
+
+from stockrec import metrics
+from stockrec.extract import extract_forecast
+
+
+class TestMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.enabled = False
+        metrics.reset()
+
+    def test_disabled_records_nothing(self):
+        extract_forecast('Carnegie sänker Thule till behåll (köp), riktkurs 220 kronor.', datetime.date(2020, 3, 2))
+        self.assertEqual({'counters': [], 'latencies': []}, metrics.summary())
+
+    def test_extractors_are_recorded(self):
+        metrics.enable()
+        extract_forecast('Carnegie sänker Thule till behåll (köp), riktkurs 220 kronor.', datetime.date(2020, 3, 2))
+        text = metrics.prometheus_text()
+        self.assertIn('stockrec_extractor_total{extractor="simple",result="hit"} 1\n', text)
+        self.assertIn('stockrec_tokenize_seconds_count 1\n', text)
+        self.assertIn('stockrec_extractor_seconds_bucket{extractor="simple",le="+Inf"} 1\n', text)
+
+    def test_quantiles(self):
+        h = metrics.Histogram()
+        for n in range(1, 101):
+            h.observe(n * 1e-3)
+        self.assertAlmostEqual(0.05, h.quantile(0.5), delta=0.02)
+        self.assertAlmostEqual(0.099, h.quantile(0.99), delta=0.04)
+        self.assertIsNone(metrics.Histogram().quantile(0.5))
@@ -0,0 +1,40 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+from stockrec.pipeline import run_pipeline
+from stockrec.sqlitestore import SqliteStorage
+from stockrec.storage import StoreResult
+
+
+def fake_fetch(date):
+    if date.day == 2:
+        return str(date), date, None
+    if date.day == 3:
+        raise IOError("Connection reset")
+    return str(date), date, f"""<div class="rich-text text parbase section">
+                                <p>Carnegie sänker Thule till behåll (köp), riktkurs {200 + date.day} kronor.</p>
+                                </div>"""
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_pipeline_stores_in_order(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = SqliteStorage(os.path.join(tmp, 'stockrec.db'))
+            dates = [datetime.date(2020, 3, d) for d in range(1, 11)]
+            result = run_pipeline(dates, storage, fake_fetch, fetch_workers=4, batch_size=3, queue_size=2)
+            self.assertEqual((10, 1, 8, StoreResult(8, 0, 0)), result)
+            stored = storage.forecasts_for_company('Thule')
+            self.assertEqual([d for d in dates if d.day not in [2, 3]], [f.date for f in stored])
+            storage.close()
+
+    def test_parse_in_worker_processes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = SqliteStorage(os.path.join(tmp, 'stockrec.db'))
+            dates = [datetime.date(2020, 3, d) for d in range(4, 10)]
+            result = run_pipeline([fake_fetch(d) for d in dates], storage, parse_workers=2, batch_size=4)
+            self.assertEqual((6, 0, 6, StoreResult(6, 0, 0)), result)
+            self.assertEqual(dates, [f.date for f in storage.forecasts_for_company('Thule')])
+            storage.close()
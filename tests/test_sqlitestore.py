@@ -0,0 +1,48 @@
+import datetime
+import os
+import tempfile
+import unittest
+from decimal import Decimal
+
+from stockrec.extract import extract_forecast, refresh_forecasts
+from stockrec.sqlitestore import SqliteStorage
+from stockrec.storage import StoreResult
+
+
+class TestSqliteStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.storage = SqliteStorage(os.path.join(self.dir.name, 'stockrec.db'))
+        self.date = datetime.date(2020, 3, 2)
+        self.forecast = extract_forecast('Carnegie sänker Thule till behåll (köp), riktkurs 220 kronor.', self.date)
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def test_store_is_idempotent(self):
+        self.assertEqual(StoreResult(1, 0, 0), self.storage.store(self.forecast))
+        self.assertEqual(StoreResult(0, 0, 1), self.storage.store(self.forecast))
+        self.assertEqual(StoreResult(0, 1, 0), self.storage.store(self.forecast._replace(company='Tesla')))
+        self.assertEqual([self.forecast._replace(company='Tesla')], list(self.storage.fetch_stored_raw()))
+        self.assertEqual(Decimal('220'), self.storage.forecasts_for_company('Tesla')[0].forecast_price)
+
+    def test_locked_forecast_is_not_updated(self):
+        self.storage.store(self.forecast)
+        self.storage._con.execute("UPDATE forecasts SET locked = 1")
+        self.assertEqual(StoreResult(0, 0, 1), self.storage.store(self.forecast._replace(company='Tesla')))
+        self.assertEqual([self.forecast], list(self.storage.fetch_stored_raw()))
+        self.assertEqual([], list(self.storage.fetch_stored_raw(stale_only=True)))
+
+    def test_stale_only_fetches_older_versions(self):
+        failed = extract_forecast('Inget att se här.', self.date)
+        self.storage.store_many([self.forecast, failed])
+        self.assertEqual([], list(self.storage.fetch_stored_raw(stale_only=True)))
+        self.storage._con.execute("UPDATE forecasts SET extractor_version = 'old', content_md5 = 'old'")
+        self.assertEqual(sorted([self.forecast.raw, failed.raw]),
+                         sorted(f.raw for f in self.storage.fetch_stored_raw(stale_only=True)))
+        result = refresh_forecasts(list(self.storage.fetch_stored_raw(stale_only=True)), keep_unchanged=True)
+        self.assertEqual([failed.raw], result.failed)
+        self.storage.store_many(result.changed + result.unchanged)
+        self.assertEqual([], list(self.storage.fetch_stored_raw(stale_only=True)))